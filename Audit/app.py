@@ -2,16 +2,21 @@
 import logging
 import uuid
 import connexion
-import json
 import datetime
 from connexion import NoContent
 import os
+import time
+from threading import Thread, Lock
 from swagger_ui_bundle import swagger_ui_path
 import requests
 import yaml
 import logging.config
 from pykafka import KafkaClient
+from pykafka.common import OffsetType
 from flask_cors import CORS, cross_origin
+import envelope
+from offset_index import OffsetIndex
+from trace_index import TraceIndex
 
 # Check environment and load configuration files
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
@@ -34,61 +39,180 @@ logger = logging.getLogger('basicLogger')
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
-def get_personal_info(index):
-    """ Retrieves a personal information record from Kafka topic based on the index."""
-    # Configure Kafka client
-    hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
-    
-    # Create Kafka consumer
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-    logger.info("Retrieving personal info at index %d" % index)
-    
-    try:
-        lst = []
-        # Read messages from Kafka topic
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            logger.debug(msg['type'])
-            # Check for specific type of message
-            if msg['type'] == 'personal_info':
-               lst.append(msg) 
-        # Return the message at the specified index
-        logger.debug(lst[index])  
-        return lst[index], 201
-
-    except IndexError:
-        # Handle case where index is out of range
-        logger.error("No more messages found")
-    logger.error("Could not find personal info at index %d" % index)
-    return {"message": "Not Found"}, 404
-
-def get_food_log(index):
-    """ Retrieves a food log record from Kafka topic based on the index."""
-    # Configuration and setup similar to get_personal_info function
-    hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-    logger.info("Retrieving food_log at index %d" % index)
-    
+# Where each personal info and food log event is on the topic, filled by index_events()
+OFFSET_INDEX = OffsetIndex(['personal_info', 'food_log'])
+TRACE_INDEX = TraceIndex(app_config['trace']['filename'])
+TOPIC = None
+# partition id -> consumer of that partition alone, for fetching single messages, and its lock
+READERS = {}
+READERS_LOCK = Lock()
+
+def connect_events_topic():
+    """ The events topic, retrying the Kafka connection up to kafka.max_retries times """
+    max_retries = app_config["kafka"]["max_retries"]
+    current_retry = 0
+    while current_retry < max_retries:
+        try:
+            logger.info(f'Attempting to connect to Kafka. Retry count: {current_retry}')
+            hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
+            client = KafkaClient(hosts=hostname)
+            return client.topics[str.encode(app_config["events"]["topic"])]
+        except Exception as e:
+            logger.error(f'Connection to Kafka failed. Error:{str(e)}')
+            time.sleep(app_config['kafka']['sleep_time'])
+            current_retry += 1
+    logger.error("Max Retries reached. Could not connect to Kafka")
+    return None
+
+def index_events():
+    """ Reads the topic from the start once, then follows it, adding every event to OFFSET_INDEX and TRACE_INDEX """
+    global TOPIC
+    TOPIC = connect_events_topic()
+    if TOPIC is None:
+        return
+
+    # Times out so the trace rows of the last events are flushed while the topic is quiet
+    consumer = TOPIC.get_simple_consumer(auto_offset_reset=OffsetType.EARLIEST, reset_offset_on_start=True,
+                                         consumer_timeout_ms=app_config['trace']['flush_ms'])
+    logger.info("Indexing the events topic")
+    flush_events = app_config['trace']['flush_events']
+    flush_sec = app_config['trace']['flush_ms'] / 1000
+    last_flush = time.time()
+    while True:
+        msg = consumer.consume()
+        if msg is not None:
+            try:
+                event = envelope.decode(msg.value)
+            except Exception as e:
+                logger.error(f"Not indexing undecodable event at offset {msg.offset}: {e}")
+                event = None
+            if event is not None:
+                OFFSET_INDEX.add(event['type'], msg.partition_id, msg.offset)
+                # The message timestamp is when Kafka appended it with message.timestamp.type=LogAppendTime
+                TRACE_INDEX.add(event['payload'].get('trace_id'), event['type'], msg.partition_id, msg.offset,
+                                event.get('received_at_ms'), msg.timestamp or None)
+
+        if len(TRACE_INDEX.pending) >= flush_events or time.time() - last_flush >= flush_sec:
+            TRACE_INDEX.flush()
+            last_flush = time.time()
+
+def init_index():
+    t = Thread(target=index_events)
+    t.setDaemon(True)
+    t.start()
+
+def partition_reader(partition_id):
+    """ The consumer of one partition used for lookups, and the lock to hold while using it """
+    with READERS_LOCK:
+        if partition_id not in READERS:
+            consumer = TOPIC.get_simple_consumer(partitions=[TOPIC.partitions[partition_id]],
+                                                 consumer_timeout_ms=app_config['index']['fetch_timeout_ms'])
+            READERS[partition_id] = (consumer, Lock())
+        return READERS[partition_id]
+
+def read_partition(partition_id, offsets):
+    """ The events at the given offsets of a partition, by offset; missing ones (e.g. expired) are left out """
+    consumer, lock = partition_reader(partition_id)
+    events = {}
+    with lock:
+        # The consumer resumes after the offset it is reset to (-1 would mean the latest one)
+        first, last = min(offsets), max(offsets)
+        consumer.reset_offsets([(TOPIC.partitions[partition_id], first - 1 if first > 0 else OffsetType.EARLIEST)])
+        msg = consumer.consume()
+        while msg is not None and msg.offset <= last:
+            if msg.offset in offsets:
+                events[msg.offset] = envelope.decode(msg.value)
+            msg = consumer.consume() if msg.offset < last else None
+    return events
+
+def read_events(locations):
+    """ The events at (partition_id, offset) locations, in their order, one pass per partition """
+    offsets_by_partition = {}
+    for partition_id, offset in locations:
+        offsets_by_partition.setdefault(partition_id, set()).add(offset)
+    events = {}
+    for partition_id, offsets in offsets_by_partition.items():
+        for offset, event in read_partition(partition_id, offsets).items():
+            events[(partition_id, offset)] = event
+    return [events[location] for location in locations if location in events]
+
+def get_events(event_type, index, start, count):
+    """ The event at index, or count events from index start """
+    if TOPIC is None:
+        return {"message": "The events topic is not available"}, 503
+    if start is not None:
+        logger.info(f"Retrieving {count} {event_type} from index {start}")
+        return read_events(OFFSET_INDEX.locate_range(event_type, start, count)), 200
+    if index is None:
+        return {"message": "Either index or start is required"}, 400
+
+    logger.info(f"Retrieving {event_type} at index {index}")
+    location = OFFSET_INDEX.locate(event_type, index)
+    events = [] if location is None else read_events([location])
+    if not events:
+        logger.error(f"Could not find {event_type} at index {index}")
+        return {"message": "Not Found"}, 404
+    logger.debug(events[0])
+    return events[0], 201
+
+def fetch_stored_reading(trace_id):
+    """ Storage's reading of a trace ID and when it was stored, None when it has none (yet) """
     try:
-        lst = []
-        # Read and process messages from Kafka
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            logger.debug(msg)
-            if msg['type'] == 'food_log':
-               lst.append(msg) 
-        return lst[index], 201
-
-    except IndexError:
-        logger.error("No more messages found")
-    logger.error("Could not find food log at index %d" % index)
-    return {"message": "Not Found"}, 404
+        response = requests.get(f"{app_config['eventstore']['url']}/trace/{trace_id}",
+                                timeout=app_config['eventstore']['timeout_sec'])
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Could not ask Storage for trace ID {trace_id}: {e}")
+        return None
+    if response.status_code != 200:
+        if response.status_code != 404:
+            logger.error(f"Storage answered {response.status_code} for trace ID {trace_id}")
+        return None
+    return response.json()
+
+def get_trace(trace_id):
+    """ Follows a trace ID through the pipeline: its Kafka event, its Storage row and the time spent at each hop """
+    if TOPIC is None:
+        return {"message": "The events topic is not available"}, 503
+    trace = TRACE_INDEX.find(trace_id)
+    if trace is None:
+        return {"message": f"No event with trace ID {trace_id} was indexed"}, 404
+
+    events = read_events([(trace['partition_id'], trace['topic_offset'])])
+    stored = fetch_stored_reading(trace_id)
+    received_at_ms = trace['received_at_ms']
+    appended_at_ms = trace['appended_at_ms']
+    stored_at_ms = None if stored is None else stored['stored_at_ms']
+
+    def elapsed(start, end):
+        return None if start is None or end is None else end - start
+
+    # Hops are timed by different hosts, so they are only as exact as their clocks agree
+    return {
+        "trace_id": trace_id,
+        "type": trace['event_type'],
+        "partition": trace['partition_id'],
+        "offset": trace['topic_offset'],
+        "event": events[0] if events else None,
+        "reading": None if stored is None else stored['reading'],
+        "timestamps": {
+            "received_at_ms": received_at_ms,
+            "appended_at_ms": appended_at_ms,
+            "stored_at_ms": stored_at_ms
+        },
+        "latency_ms": {
+            "receiver_to_kafka": elapsed(received_at_ms, appended_at_ms),
+            "kafka_to_storage": elapsed(appended_at_ms, stored_at_ms),
+            "total": elapsed(received_at_ms, stored_at_ms)
+        }
+    }, 200
+
+def get_personal_info(index=None, start=None, count=10):
+    """ Retrieves personal information records from the Kafka topic based on their index."""
+    return get_events('personal_info', index, start, count)
+
+def get_food_log(index=None, start=None, count=10):
+    """ Retrieves food log records from the Kafka topic based on their index."""
+    return get_events('food_log', index, start, count)
 
 def healthCheck():
     return 200
@@ -101,4 +225,5 @@ if "TARGET_ENV" not in os.environ or os.environ["TARGET_ENV"] != "test":
 
 # Run the application if this script is executed as the main program
 if __name__ == "__main__":
+    init_index()
     app.run(port=8110)
@@ -0,0 +1,49 @@
+"""
+Where each event of a type is on the events topic, by its index among them.
+
+The audit endpoints look events up by index (the 100th personal info event,
+...). Rather than reading the topic from the start for every lookup, one
+consumer reads it once and then follows it, appending the partition and offset
+of each event to arrays per type. A lookup finds the position in the arrays
+and fetches that single message, so it costs the same however long the topic
+is. An entry is 12 bytes, so millions of events fit in a few MB.
+
+Indexes follow the order the indexing consumer read the events in; nothing is
+saved, the index is rebuilt from the topic on start.
+"""
+from array import array
+from threading import Lock
+
+
+class OffsetIndex:
+    """ Partition and offset of every event consumed, per event type """
+
+    def __init__(self, event_types):
+        self.partitions = {event_type: array('i') for event_type in event_types}
+        self.offsets = {event_type: array('q') for event_type in event_types}
+        self.lock = Lock()
+
+    def add(self, event_type, partition_id, offset):
+        """ Appends an event, unless it is of a type that is not indexed """
+        with self.lock:
+            if event_type in self.partitions:
+                self.partitions[event_type].append(partition_id)
+                self.offsets[event_type].append(offset)
+
+    def count(self, event_type):
+        with self.lock:
+            return len(self.offsets[event_type])
+
+    def locate(self, event_type, index):
+        """ (partition_id, offset) of the event at index (negative from the end like a list), None past the end """
+        with self.lock:
+            offsets = self.offsets[event_type]
+            if not -len(offsets) <= index < len(offsets):
+                return None
+            return self.partitions[event_type][index], offsets[index]
+
+    def locate_range(self, event_type, start, count):
+        """ (partition_id, offset) of up to count events from index start """
+        with self.lock:
+            end = start + count
+            return list(zip(self.partitions[event_type][start:end], self.offsets[event_type][start:end]))
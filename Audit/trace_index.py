@@ -0,0 +1,58 @@
+"""
+Where the event of each trace ID is on the events topic, and when it got there.
+
+The indexing consumer adds every event it reads: its partition and offset, when
+the Receiver produced it (the envelope's received_at_ms) and when Kafka
+appended it (the message timestamp). There is one row per event ever produced,
+so the index is a SQLite file rather than memory. Rows are written in batches;
+an event can be looked up once its batch is flushed.
+
+Rows are keyed by trace_id, so indexing the topic again after a restart only
+rewrites them.
+"""
+import sqlite3
+from threading import Lock
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS traces (
+    trace_id TEXT PRIMARY KEY,
+    event_type TEXT NOT NULL,
+    partition_id INTEGER NOT NULL,
+    topic_offset INTEGER NOT NULL,
+    received_at_ms INTEGER,
+    appended_at_ms INTEGER
+) WITHOUT ROWID
+"""
+COLUMNS = ('trace_id', 'event_type', 'partition_id', 'topic_offset', 'received_at_ms', 'appended_at_ms')
+
+
+class TraceIndex:
+    """ trace_id -> partition, offset and timestamps of its event, in a SQLite file """
+
+    def __init__(self, filename):
+        # Written by the indexing consumer, read by the request threads, one at a time
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(SCHEMA)
+        self.pending = []
+        self.lock = Lock()
+
+    def add(self, trace_id, event_type, partition_id, offset, received_at_ms, appended_at_ms):
+        """ Queues an event's row until the next flush() """
+        self.pending.append((trace_id, event_type, partition_id, offset, received_at_ms, appended_at_ms))
+
+    def flush(self):
+        """ Writes the queued rows in one transaction """
+        if not self.pending:
+            return
+        rows, self.pending = self.pending, []
+        with self.lock, self.connection:
+            self.connection.executemany(f"INSERT OR REPLACE INTO traces ({', '.join(COLUMNS)}) "
+                                        f"VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+
+    def find(self, trace_id):
+        """ The row of a trace ID as a dictionary, None when it was not indexed """
+        with self.lock:
+            row = self.connection.execute(f"SELECT {', '.join(COLUMNS)} FROM traces WHERE trace_id = ?",
+                                          (trace_id,)).fetchone()
+        return None if row is None else dict(zip(COLUMNS, row))
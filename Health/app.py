@@ -3,12 +3,16 @@ import yaml
 import logging
 import logging.config
 import datetime
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
-import json
 import os.path
 from flask_cors import CORS, cross_origin
 from connexion import NoContent
+from snapshot import Snapshot
+from probe_stats import ProbeStats
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
@@ -31,89 +35,65 @@ logger = logging.getLogger('basicLogger')
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
-if os.path.isfile(app_config['datastore']['filename']):
-        f = open(app_config['datastore']['filename'])
-        f_content = f.read()
-        json_object = json.loads(f_content)
-        f.close()
-else:
-    json_object = {'receiver_health': False,
-                    'storage_health': False,
-                    'processing_health': False,
-                    'audit_health': False,
-                    'last_updated': "2023-10-12T11:06:15.894272"}
-    file_path = app_config['datastore']['filename']
-    with open(file_path, 'w') as data_json:
-        json.dump(json_object, data_json, indent=4)
+# The health served, encoded once per check and saved to the data file
+HEALTH_SNAPSHOT = Snapshot(app_config['datastore']['filename'])
+HEALTH_SNAPSHOT.publish(HEALTH_SNAPSHOT.load() or {'receiver_health': False,
+                                                   'storage_health': False,
+                                                   'processing_health': False,
+                                                   'audit_health': False,
+                                                   'last_updated': "2023-10-12T11:06:15.894272"})
+
+SERVICES = ['receiver', 'storage', 'processing', 'audit']
+# Keep-alive connections to every service, one probe thread each
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_maxsize=len(SERVICES)))
+SESSION.mount('https://', HTTPAdapter(pool_maxsize=len(SERVICES)))
+PROBE_EXECUTOR = ThreadPoolExecutor(max_workers=len(SERVICES))
+# Response times of each service's last probe.window_size probes
+PROBE_STATS = {service: ProbeStats(app_config['probe']['window_size']) for service in SERVICES}
 
 def get_health():
-    if os.path.isfile(app_config['datastore']['filename']):
-        f = open(app_config['datastore']['filename'])
-        f_content = f.read()
-        json_object = json.loads(f_content)
-        f.close()
-        return json_object, 201
-    else:
-        logger.error("File does not exist")
-        return "stats do not exist", 404
+    return HEALTH_SNAPSHOT.response(201)
+
+def probe(service):
+    """ Calls a service's /health, returning (status, response time in ms, error or None) """
+    started = time.perf_counter()
+    try:
+        response = SESSION.get(f"{app_config['urls'][service]}/health", timeout=app_config['probe']['timeout_sec'])
+        error = None if response.status_code == 200 else f"HTTP {response.status_code}"
+    except requests.exceptions.RequestException as e:
+        error = f"{type(e).__name__}: {e}"
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+    return "Running" if error is None else "Down", elapsed_ms, error
 
 def health_check():
-    if os.path.isfile(app_config['datastore']['filename']):
-        f = open(app_config['datastore']['filename'])
-        f_content = f.read()
-        json_object = json.loads(f_content)
-        f.close()
-    else:
-        json_object = {'receiver_health': False,
-                        'storage_health': False,
-                        'processing_health': False,
-                        'audit_health': False,
-                        'last_updated': "2023-10-12T11:06:15.894272"}
-    file_path = app_config['datastore']['filename']
-    with open(file_path, 'w') as data_json:
-        json.dump(json_object, data_json, indent=4)
-
-
     now = datetime.datetime.now()
     timestamp = now.strftime('%Y-%m-%dT%H:%M:%S.%f')
 
     logger.info("Health check beginning")
-    check_receiver = requests.get(f"{app_config['urls']['receiver']}/health")
-    check_storage = requests.get(f"{app_config['urls']['storage']}/health")
-    check_processing = requests.get(f"{app_config['urls']['processing']}/health")
-    check_audit = requests.get(f"{app_config['urls']['audit']}/health")
-
-    logger.info(f"Health check over")
-    if check_receiver.status_code == 200:
-        logger.info(f"Receiver is health: {check_receiver.status_code}")
-        health_receiver = "Running"
-    else:
-        health_receiver = "Down"
-    if check_storage.status_code == 200:
-        logger.info(f"Receiver is health: {check_storage.status_code}")
-        health_storage = "Running"
-    else:
-        health_storage = "Down"
-    if check_processing.status_code == 200:
-        logger.info(f"Receiver is health: {check_processing.status_code}")
-        health_processing = "Running"
-    else:
-        health_processing = "Down"
-    if check_audit.status_code == 200:
-        logger.info(f"Receiver is health: {check_audit.status_code}")
-        health_audit = "Running"
-    else:
-        health_audit = "False"
-    health_dict =  {'receiver_health': health_receiver,
-                        'storage_health': health_storage,
-                        'processing_health': health_processing,
-                        'audit_health': health_audit,
-                        'last_updated': timestamp}
-    f = open(app_config['datastore']['filename'], 'w')
-    f.write(json.dumps(health_dict))
-    f.close()
+    # Probed at the same time, so a hung service only costs the sweep its own timeout
+    started = time.perf_counter()
+    results = dict(zip(SERVICES, PROBE_EXECUTOR.map(probe, SERVICES)))
+    sweep_ms = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(f"Health check over in {sweep_ms} ms")
+
+    health_dict = {}
+    services = {}
+    for service, (status, elapsed_ms, error) in results.items():
+        PROBE_STATS[service].record(elapsed_ms, error, timestamp)
+        if error is None:
+            logger.info(f"{service.capitalize()} is healthy, responded in {elapsed_ms} ms")
+        else:
+            logger.warning(f"{service.capitalize()} is down after {elapsed_ms} ms: {error}")
+        health_dict[f"{service}_health"] = status
+        services[service] = dict(PROBE_STATS[service].summary(), status=status, last_ms=elapsed_ms)
+    health_dict['last_updated'] = timestamp
+    health_dict['sweep_ms'] = sweep_ms
+    health_dict['services'] = services
+    HEALTH_SNAPSHOT.publish(health_dict)
     logger.debug(f"The current data is {health_dict}")
     logger.info(f"Processing period ended")
+
 def init_scheduler():
     sched = BackgroundScheduler(daemon=True)
     sched.add_job(health_check,
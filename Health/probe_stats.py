@@ -0,0 +1,40 @@
+"""
+Response times of a service's health probes over its last few probes.
+
+Every probe is timed, including the ones that fail or time out, so a service
+that stalls shows up as high percentiles (a timed out probe counts as the
+timeout) rather than only as Down. The window has a fixed number of samples;
+percentiles are computed over a sorted copy of it when the health is published.
+"""
+import math
+from collections import deque
+from threading import Lock
+
+PERCENTILES = {'p50_ms': 0.5, 'p95_ms': 0.95, 'p99_ms': 0.99}
+
+
+class ProbeStats:
+    """ Last window_size response times of one service, and its last error """
+
+    def __init__(self, window_size):
+        self.samples = deque(maxlen=window_size)
+        self.last_error = None
+        self.last_error_at = None
+        self.lock = Lock()
+
+    def record(self, elapsed_ms, error=None, timestamp=None):
+        """ Adds a probe's response time; error is why it failed, None when the service was healthy """
+        with self.lock:
+            self.samples.append(elapsed_ms)
+            if error is not None:
+                self.last_error = error
+                self.last_error_at = timestamp
+
+    def summary(self):
+        """ Nearest-rank percentiles of the window, None while it is empty """
+        with self.lock:
+            samples = sorted(self.samples)
+            summary = {'samples': len(samples), 'last_error': self.last_error, 'last_error_at': self.last_error_at}
+        for name, q in PERCENTILES.items():
+            summary[name] = samples[max(math.ceil(q * len(samples)) - 1, 0)] if samples else None
+        return summary
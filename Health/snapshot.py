@@ -0,0 +1,72 @@
+"""
+The document a GET endpoint serves, kept in memory and already encoded.
+
+Requests are answered from the bytes in memory with an ETag, so they cost no
+disk I/O or JSON encoding, and a client sending the ETag back in If-None-Match
+gets a 304. Whoever computes a new document publishes it: it is encoded once,
+saved to the data file (write to a temporary file, fsync, os.replace) and only
+then swapped in, so neither requests nor a restart can see a partial file.
+"""
+import hashlib
+import json
+import os
+from threading import Lock
+
+from flask import Response, request
+
+
+def write_atomically(filename, document):
+    """ Replaces a JSON file, so a crash leaves either the old or the new one """
+    temporary = f"{filename}.tmp"
+    with open(temporary, 'w') as f:
+        json.dump(document, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, filename)
+
+
+class Snapshot:
+    """ Served bytes and ETag of a document, and the data file it is saved to (None to keep it in memory) """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.saved = None
+        self.body = None
+        self.etag = None
+        self.lock = Lock()
+
+    def load(self):
+        """ The document last saved, None when there is none """
+        if self.filename is None or not os.path.isfile(self.filename):
+            return None
+        with open(self.filename) as f:
+            return json.load(f)
+
+    def publish(self, served, saved=None):
+        """ Serves a new document; saved, when given, is what goes to the data file (served by default) """
+        body = json.dumps(served).encode('utf-8')
+        etag = hashlib.md5(body).hexdigest()
+        saved = served if saved is None else saved
+        if self.filename is not None:
+            write_atomically(self.filename, saved)
+        with self.lock:
+            self.saved = saved
+            self.body = body
+            self.etag = etag
+
+    def response(self, status=200):
+        """ The current document, or 304 when the client already has it """
+        with self.lock:
+            body, etag = self.body, self.etag
+        if body is None:
+            return None
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        response = Response(iter((body,)), status=status, mimetype="application/json")
+        response.headers["Content-Length"] = str(len(body))
+        response.set_etag(etag)
+        # Stops connexion from parsing the body again to validate it
+        response.direct_passthrough = True
+        return response
@@ -4,11 +4,24 @@ import yaml
 import logging.config
 import datetime
 import requests
+from requests.adapters import HTTPAdapter
 from apscheduler.schedulers.background import BackgroundScheduler
-import json
 import os
+import time
+from threading import Thread
+import bisect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
 from flask_cors import CORS, cross_origin
 from connexion import NoContent
+import envelope
+from stream_stats import StreamStats, EMPTY_STATS
+from snapshot import Snapshot
+from sketches import ReadingSketches
+from stats_history import StatsHistory
+from user_windows import UserWindows
 
 # Check environment and load configuration files
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
@@ -31,90 +44,456 @@ logger = logging.getLogger('basicLogger')
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
-# Check for existing data file and initialize it if necessary
-if os.path.isfile(app_config['datastore']['filename']):
-    f = open(app_config['datastore']['filename'])
-    f_content = f.read()
-    current_stats = json.loads(f_content)
-    f.close()
+# Keep-alive connections to Storage, enough for the concurrent fetches of a catch-up
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_maxsize=app_config['catchup']['concurrency']))
+SESSION.mount('https://', HTTPAdapter(pool_maxsize=app_config['catchup']['concurrency']))
+
+# Where a catch-up after downtime is at, see catch_up()
+CATCHUP_PROGRESS = {'active': False, 'target': None, 'chunks_done': 0, 'chunks_total': 0}
+
+def served_stats(saved_stats):
+    """ The stats get_stats returns: the data file's, with what the sketches estimate instead of the sketches """
+    stats = dict(saved_stats)
+    sketches = ReadingSketches.from_dict(app_config['sketches'], stats.pop('sketches', None))
+    # Served at /stats/history instead
+    stats.pop('history', None)
+    stats.update(sketches.summary())
+    stats['catchup'] = dict(CATCHUP_PROGRESS)
+    return stats
+
+# With stats.source: stream the stats are kept in memory by the events consumer
+STREAM_STATS = None
+if app_config['stats']['source'] == 'stream':
+    STREAM_STATS = StreamStats(app_config['stream']['checkpoint_filename'], app_config['sketches'],
+                               app_config['history']['resolutions'])
+
+# The stats served, encoded once per update; in stream mode the checkpoint is what gets saved
+# HISTORY is saved with the stats too, so it always counts the same readings
+if STREAM_STATS is not None:
+    STATS_SNAPSHOT = Snapshot()
+    STATS_SNAPSHOT.publish(STREAM_STATS.snapshot())
+    HISTORY = STREAM_STATS.history
 else:
-    current_stats = {
-        'num_users': 0,
-        'max_age': 0,
-        'max_weight': 0,
-        'num_food_log': 0,
-        'max_calories': 0,
-        'last_updated': "2000-01-01T00:00:00Z"}
-    file_path = app_config['datastore']['filename']
-    with open(file_path, 'w') as data_json:
-        json.dump(current_stats, data_json, indent=4)
+    STATS_SNAPSHOT = Snapshot(app_config['datastore']['filename'])
+    saved_stats = STATS_SNAPSHOT.load() or dict(EMPTY_STATS)
+    STATS_SNAPSHOT.publish(served_stats(saved_stats), saved_stats)
+    HISTORY = StatsHistory(app_config['history']['resolutions'])
+    if saved_stats.get('history') and not HISTORY.decode(saved_stats['history']):
+        logger.warning("The saved history has other resolutions than configured, starting a new one")
+
+# Per user rolling totals, fed the same readings as the stats
+USER_WINDOWS = UserWindows(app_config['user_windows']['windows_days'])
 
 def get_stats():
-    if os.path.isfile(app_config['datastore']['filename']):
-        f = open(app_config['datastore']['filename'])
-        f_content = f.read()
-        current_stats = json.loads(f_content)
-        f.close()
-        return current_stats, 201
-    else:
-        logger.error("File does not exist")
-        return "stats do not exist", 404
+    return STATS_SNAPSHOT.response(201)
 
 
-def populate_stats():
-    if os.path.isfile(app_config['datastore']['filename']):
-        with open(app_config['datastore']['filename']) as f:
-            current_stats = json.loads(f.read())
-    else:
-        current_stats = {
-            'num_users': 0,
-            'max_age': 0,
-            'max_weight': 0,
-            'num_food_log': 0,
-            'max_calories': 0,
-            'last_updated': "2000-01-01T00:00:00Z"
-        }
-    
-    now = datetime.datetime.now()
-    timestamp = now.strftime('%Y-%m-%dT%H:%M:%SZ')
+def get_stats_history(resolution='minute', from_=None, to=None):
+    """ The counts and maxima of every bucket of a resolution between from and to, oldest first """
+    if resolution not in HISTORY.levels:
+        return {"message": f"Unknown resolution {resolution}, expected one of {', '.join(HISTORY.levels)}"}, 400
+    level = HISTORY.levels[resolution]
+    try:
+        end = int(time.time()) if to is None else envelope.parse_datetime(to)
+        # By default, every bucket the resolution keeps
+        start = end - level.width_sec * level.buckets if from_ is None else envelope.parse_datetime(from_)
+    except ValueError:
+        return {"message": "Invalid timestamp format"}, 400
+    if start >= end:
+        return {"message": "from must be earlier than to"}, 400
 
-    logger.info("Start Periodic Processing")
-    
-    personal_info_url = requests.get(f"{app_config['eventstore']['url']}/personal-info", params={'start_timestamp':current_stats['last_updated'], 'end_timestamp': timestamp})
-    food_log_url = requests.get(f"{app_config['eventstore']['url']}/food-log", params={'start_timestamp':current_stats['last_updated'], 'end_timestamp': timestamp})
-    logger.info(f"There have been {len(personal_info_url.json())} personal info logs and {len(food_log_url.json())} food logged since {current_stats['last_updated']}")
+    buckets = HISTORY.buckets(resolution, start, end)
+    for bucket in buckets:
+        bucket['start'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(bucket['start']))
+    return {'resolution': resolution, 'width_sec': level.width_sec, 'buckets': buckets}, 200
+
+
+def get_window_readings(window):
+    """ Downloads every reading in the window from Storage and reduces them here """
+    timeout = app_config['eventstore']['timeout_sec']
+    personal_info_url = SESSION.get(f"{app_config['eventstore']['url']}/personal-info", params=window, timeout=timeout)
+    food_log_url = SESSION.get(f"{app_config['eventstore']['url']}/food-log", params=window, timeout=timeout)
 
     if personal_info_url.status_code != 200 or food_log_url.status_code != 200:
         logger.error('Error from personal info or food log received')
-        return  # Exit the function if there's an error
+        return None
 
     personal_info_response = personal_info_url.json()
     food_log_response = food_log_url.json()
+    logger.info(f"There have been {len(personal_info_response)} personal info logs and {len(food_log_response)} food logged since {window['start_timestamp']}")
+
+    sketches = ReadingSketches(app_config['sketches'])
+    for reading in personal_info_response:
+        sketches.add_personal_info(reading)
+    for reading in food_log_response:
+        sketches.add_food_log(reading)
+
+    return {
+        'num_personal_info': len(personal_info_response),
+        'max_age': max([float(i["age"]) for i in personal_info_response], default=None),
+        'max_weight': max([float(i['weight']) for i in personal_info_response], default=None),
+        'num_food_log': len(food_log_response),
+        'max_calories': max([float(i['calories']) for i in food_log_response], default=None),
+        'sketches': sketches,
+        'food_logs': food_log_response,
+        'profiles': personal_info_response
+    }
+
+
+def get_window_aggregates(window):
+    """ Asks Storage for the window's count and max values instead of downloading its rows (so no sketches) """
+    timeout = app_config['eventstore']['timeout_sec']
+    personal_info_url = SESSION.get(f"{app_config['eventstore']['url']}/personal-info/stats", params=window, timeout=timeout)
+    food_log_url = SESSION.get(f"{app_config['eventstore']['url']}/food-log/stats", params=window, timeout=timeout)
 
-    # Update max_age and num_users based on new data
-    new_max_age = max([float(i["age"]) for i in personal_info_response], default=current_stats['max_age'])
-    new_num_users = current_stats['num_users'] + len(personal_info_response)
+    if personal_info_url.status_code != 200 or food_log_url.status_code != 200:
+        logger.error('Error from personal info or food log stats received')
+        return None
+
+    personal_info_stats = personal_info_url.json()
+    food_log_stats = food_log_url.json()
+    logger.info(f"There have been {personal_info_stats['count']} personal info logs and {food_log_stats['count']} food logged since {window['start_timestamp']}")
+
+    def field_max(stats, field):
+        value = stats['fields'][field]['max']
+        return None if value is None else float(value)
+
+    return {
+        'num_personal_info': personal_info_stats['count'],
+        'max_age': field_max(personal_info_stats, 'age'),
+        'max_weight': field_max(personal_info_stats, 'weight'),
+        'num_food_log': food_log_stats['count'],
+        'max_calories': field_max(food_log_stats, 'calories'),
+        'sketches': None,
+        'food_logs': None,
+        'profiles': None
+    }
 
-    # Update max_weight and max_calories if new data is available
-    new_max_weight = max([float(i['weight']) for i in personal_info_response], default=current_stats['max_weight'])
-    new_max_calories = max([float(i['calories']) for i in food_log_response], default=current_stats['max_calories'])
 
-    updated_stats = {
+def fetch_window(window):
+    """ The stats of a window's readings, None when Storage could not be asked for them """
+    try:
+        if app_config['eventstore'].get('use_aggregates', False):
+            return get_window_aggregates(window)
+        return get_window_readings(window)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Request for {window} failed: {e}")
+        return None
+
+
+def merge_window_stats(first, second):
+    """ Stats of two windows combined as if they were one (the order does not matter) """
+    def larger(a, b):
+        return a if b is None else b if a is None else max(a, b)
+
+    sketches = first['sketches'] if second['sketches'] is None else second['sketches']
+    if first['sketches'] is not None and second['sketches'] is not None:
+        sketches = first['sketches']
+        sketches.merge(second['sketches'])
+    return {
+        'num_personal_info': first['num_personal_info'] + second['num_personal_info'],
+        'max_age': larger(first['max_age'], second['max_age']),
+        'max_weight': larger(first['max_weight'], second['max_weight']),
+        'num_food_log': first['num_food_log'] + second['num_food_log'],
+        'max_calories': larger(first['max_calories'], second['max_calories']),
+        'sketches': sketches,
+        'food_logs': None,
+        'profiles': None
+    }
+
+
+def apply_window(current_stats, window_stats, timestamp):
+    """ The stats once a window's are added, with last_updated moved to its end """
+    # max_* keep their previous value when the window has no readings
+    new_num_users = current_stats['num_users'] + window_stats['num_personal_info']
+    new_max_age = current_stats['max_age'] if window_stats['max_age'] is None else window_stats['max_age']
+    new_max_weight = current_stats['max_weight'] if window_stats['max_weight'] is None else window_stats['max_weight']
+    new_max_calories = current_stats['max_calories'] if window_stats['max_calories'] is None else window_stats['max_calories']
+
+    sketches = ReadingSketches.from_dict(app_config['sketches'], current_stats.get('sketches'))
+    if window_stats['sketches'] is not None:
+        sketches.merge(window_stats['sketches'])
+
+    return {
         'num_users': new_num_users,
         'max_age': new_max_age,
         'max_weight': new_max_weight,
-        'num_food_log': current_stats['num_food_log'] + len(food_log_response),
+        'num_food_log': current_stats['num_food_log'] + window_stats['num_food_log'],
         'max_calories': new_max_calories,
-        'last_updated': timestamp
+        'last_updated': timestamp,
+        'sketches': sketches.to_dict()
     }
 
-    with open(app_config['datastore']['filename'], 'w') as f:
-        f.write(json.dumps(updated_stats))
+
+def hours_with_readings(start_timestamp, end_timestamp):
+    """ Start of every hour between the timestamps that has readings, None when Storage cannot tell """
+    hours = set()
+    for path in ('personal-info/stats', 'food-log/stats'):
+        try:
+            response = SESSION.get(f"{app_config['eventstore']['url']}/{path}",
+                                   params={'start_timestamp': start_timestamp, 'end_timestamp': end_timestamp,
+                                           'group_by': 'hour'},
+                                   timeout=app_config['eventstore']['timeout_sec'])
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Request for the hours with readings failed: {e}")
+            return None
+        if response.status_code != 200:
+            return None
+        hours.update(datetime.datetime.strptime(group['key'], '%Y-%m-%dT%H:%M:%SZ')
+                     for group in response.json()['groups'])
+    return sorted(hours)
+
+
+def record_history(window_stats, end_timestamp):
+    """ Adds a window's counts and maxima to HISTORY, in the buckets of its last second """
+    HISTORY.add(envelope.parse_datetime(end_timestamp) - 1,
+                {'num_users': window_stats['num_personal_info'], 'num_food_log': window_stats['num_food_log']},
+                {'max_age': window_stats['max_age'], 'max_weight': window_stats['max_weight'],
+                 'max_calories': window_stats['max_calories']})
+
+
+def catch_up(current_stats, now):
+    """
+    Fetches the gap since last_updated in catchup.chunk_sec windows, catchup.concurrency of them at a
+    time. The windows finished so far are merged into one and saved with last_updated at the end of the
+    last of them, so an interrupted catch-up resumes from there; it stops at the first window that fails.
+    Windows without readings according to Storage's hourly aggregates are not fetched.
+    """
+    chunk = datetime.timedelta(seconds=app_config['catchup']['chunk_sec'])
+    concurrency = app_config['catchup']['concurrency']
+    windows = []
+    start = datetime.datetime.strptime(current_stats['last_updated'], '%Y-%m-%dT%H:%M:%SZ')
+    while start < now:
+        end = min(start + chunk, now)
+        windows.append({'start_timestamp': start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                        'end_timestamp': end.strftime('%Y-%m-%dT%H:%M:%SZ')})
+        start = end
+
+    hours = hours_with_readings(current_stats['last_updated'], windows[-1]['end_timestamp'])
+    def has_readings(window):
+        if hours is None:
+            return True
+        start = datetime.datetime.strptime(window['start_timestamp'], '%Y-%m-%dT%H:%M:%SZ')
+        end = datetime.datetime.strptime(window['end_timestamp'], '%Y-%m-%dT%H:%M:%SZ')
+        # First hour that ends after the window starts
+        i = bisect.bisect_right(hours, start - datetime.timedelta(hours=1))
+        return i < len(hours) and hours[i] < end
+    fetched = [window for window in windows if has_readings(window)]
+
+    logger.info(f"Catching up from {current_stats['last_updated']}: {len(fetched)} of {len(windows)} windows have readings")
+    CATCHUP_PROGRESS.update(active=True, target=windows[-1]['end_timestamp'], chunks_done=0, chunks_total=len(fetched))
+    merged = None
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # At most concurrency windows are fetched or held ahead of the oldest one not applied yet
+        futures = deque(executor.submit(fetch_window, window) for window in fetched[:concurrency])
+        for i, window in enumerate(fetched):
+            window_stats = futures.popleft().result()
+            if i + concurrency < len(fetched):
+                futures.append(executor.submit(fetch_window, fetched[i + concurrency]))
+            if window_stats is None:
+                logger.error(f"Catch-up stopped at {window['start_timestamp']}, the next run resumes from there")
+                for future in futures:
+                    future.cancel()
+                break
+
+            if window_stats['food_logs'] is not None:
+                USER_WINDOWS.add(window_stats['food_logs'], window_stats['profiles'])
+            record_history(window_stats, window['end_timestamp'])
+            merged = window_stats if merged is None else merge_window_stats(merged, window_stats)
+            # The empty windows up to the next fetched one are done too
+            done_until = fetched[i + 1]['start_timestamp'] if i + 1 < len(fetched) else windows[-1]['end_timestamp']
+            updated_stats = apply_window(current_stats, merged, done_until)
+            updated_stats['history'] = HISTORY.encode()
+            CATCHUP_PROGRESS['chunks_done'] = i + 1
+            STATS_SNAPSHOT.publish(served_stats(updated_stats), updated_stats)
+
+    CATCHUP_PROGRESS['active'] = False
+    saved_stats = STATS_SNAPSHOT.saved
+    if not fetched:
+        # No readings in the whole gap
+        saved_stats = dict(current_stats, last_updated=windows[-1]['end_timestamp'])
+    STATS_SNAPSHOT.publish(served_stats(saved_stats), saved_stats)
+    logger.info(f"Catch-up ended after {CATCHUP_PROGRESS['chunks_done']}/{len(fetched)} windows")
+
+
+def populate_stats():
+    current_stats = STATS_SNAPSHOT.saved
+
+    now = datetime.datetime.now()
+    timestamp = now.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    logger.info("Start Periodic Processing")
+
+    # After downtime, fetching the whole gap at once could time out and never move last_updated forward
+    last_updated = datetime.datetime.strptime(current_stats['last_updated'], '%Y-%m-%dT%H:%M:%SZ')
+    if (now - last_updated).total_seconds() > app_config['catchup']['chunk_sec']:
+        catch_up(current_stats, now.replace(microsecond=0))
+        return
+
+    window = {'start_timestamp': current_stats['last_updated'], 'end_timestamp': timestamp}
+    window_stats = fetch_window(window)
+    if window_stats is None:
+        return  # Exit the function if there's an error
+
+    if window_stats['food_logs'] is not None:
+        USER_WINDOWS.add(window_stats['food_logs'], window_stats['profiles'])
+    record_history(window_stats, timestamp)
+    updated_stats = apply_window(current_stats, window_stats, timestamp)
+    updated_stats['history'] = HISTORY.encode()
+    STATS_SNAPSHOT.publish(served_stats(updated_stats), updated_stats)
 
     logger.debug(f"The current data is {updated_stats}")
     logger.info("Processing period ended")
 
 
+def connect_events_topic():
+    """ The events topic, retrying the Kafka connection up to kafka.max_retries times """
+    max_retries = app_config["kafka"]["max_retries"]
+    current_retry = 0
+    while current_retry < max_retries:
+        try:
+            logger.info(f'Attempting to connect to Kafka. Retry count: {current_retry}')
+            hostname = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
+            client = KafkaClient(hosts=hostname)
+            return client.topics[str.encode(app_config["events"]["topic"])]
+        except Exception as e:
+            logger.error(f'Connection to Kafka failed. Error:{str(e)}')
+            time.sleep(app_config['kafka']['sleep_time'])
+            current_retry += 1
+    logger.error("Max Retries reached. Could not connect to Kafka")
+    return None
+
+
+def consume_events():
+    """ Folds every event into STREAM_STATS, checkpointing it every stream.checkpoint_events events or checkpoint_sec """
+    topic = connect_events_topic()
+    if topic is None:
+        return
+
+    checkpoint_events = app_config['stream']['checkpoint_events']
+    checkpoint_sec = app_config['stream']['checkpoint_sec']
+    publish_sec = app_config['stream']['publish_ms'] / 1000
+    # The checkpoint, not the consumer group, says where to resume, since only it matches the saved stats;
+    # partitions it has no offset for are read from the start
+    consumer = topic.get_simple_consumer(consumer_group=str.encode(app_config['stream']['consumer_group']),
+                                         auto_offset_reset=OffsetType.EARLIEST,
+                                         reset_offset_on_start=True,
+                                         consumer_timeout_ms=app_config['stream']['publish_ms'])
+    resume = [(topic.partitions[partition_id], offset) for partition_id, offset in STREAM_STATS.offsets.items()
+              if partition_id in topic.partitions]
+    if resume:
+        consumer.reset_offsets(resume)
+    logger.info(f"Consuming events from offsets {STREAM_STATS.offsets}")
+
+    applied = unpublished = 0
+    food_logs, profiles = [], []
+    last_checkpoint = last_publish = time.time()
+    while True:
+        msg = consumer.consume()
+        if msg is not None:
+            try:
+                event = envelope.decode(msg.value)
+            except Exception as e:
+                logger.error(f"Skipping undecodable event at offset {msg.offset}: {e}")
+                event = None
+            STREAM_STATS.apply(event, msg.partition_id, msg.offset)
+            if event is not None and event['type'] == 'food_log':
+                food_logs.append(event['payload'])
+            elif event is not None and event['type'] == 'personal_info':
+                profiles.append(event['payload'])
+            applied += 1
+            unpublished += 1
+
+        if unpublished and time.time() - last_publish >= publish_sec:
+            STATS_SNAPSHOT.publish(STREAM_STATS.snapshot())
+            unpublished = 0
+            last_publish = time.time()
+
+        if applied and (applied >= checkpoint_events or time.time() - last_checkpoint >= checkpoint_sec):
+            # Events replayed after a crash are already in the windows, which ignore them again
+            USER_WINDOWS.add(food_logs, profiles)
+            food_logs, profiles = [], []
+            STREAM_STATS.checkpoint()
+            # Only for monitoring the group's lag
+            consumer.commit_offsets()
+            logger.debug(f"Checkpointed stats after {applied} events")
+            applied = 0
+            last_checkpoint = time.time()
+
+
+def init_stream():
+    t = Thread(target=consume_events)
+    t.setDaemon(True)
+    t.start()
+
+
+def fetch_pages(path, params):
+    """ Every reading of a Storage range read, a user_windows.page_size page at a time; None on an error """
+    readings = []
+    params = dict(params, limit=app_config['user_windows']['page_size'])
+    while True:
+        response = SESSION.get(f"{app_config['eventstore']['url']}/{path}", params=params,
+                               timeout=app_config['eventstore']['timeout_sec'])
+        if response.status_code != 200:
+            logger.error(f"Error {response.status_code} from Storage's {path}")
+            return None
+        readings.extend(response.json())
+        next_after_id = response.headers.get('X-Next-After-Id')
+        if next_after_id is None:
+            return readings
+        params['after_id'] = next_after_id
+
+
+def fill_user_windows():
+    """ Loads the readings of the longest window, and the profiles of their users, from Storage into USER_WINDOWS """
+    now = datetime.datetime.now()
+    start = now - datetime.timedelta(days=max(app_config['user_windows']['windows_days']))
+    end_timestamp = now.strftime('%Y-%m-%dT%H:%M:%SZ')
+    users_per_request = app_config['user_windows']['users_per_request']
+    try:
+        food_logs = fetch_pages('food-log', {
+            'start_timestamp': start.strftime('%Y-%m-%dT%H:%M:%SZ'), 'end_timestamp': end_timestamp,
+            'fields': 'trace_id,user_id,timestamp,calories,carbohydrates,fats,proteins'})
+        if food_logs is None:
+            logger.error('Error from food log received, user windows start empty')
+            return
+        user_ids = sorted({reading['user_id'] for reading in food_logs})
+        profiles = []
+        for i in range(0, len(user_ids), users_per_request):
+            # A user's latest profile can be older than the window
+            user_profiles = fetch_pages('personal-info', {
+                'start_timestamp': "2000-01-01T00:00:00Z", 'end_timestamp': end_timestamp,
+                'user_ids': ','.join(str(user_id) for user_id in user_ids[i:i + users_per_request]),
+                'fields': 'user_id,age,sex,height,weight,activity_level,nutritional_goal'})
+            if user_profiles is None:
+                logger.error('Error from personal info received, user windows start empty')
+                return
+            profiles.extend(user_profiles)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Could not fill the user windows from Storage: {e}")
+        return
+
+    USER_WINDOWS.add(food_logs, profiles)
+    logger.info(f"Filled the user windows with {len(USER_WINDOWS.food_logs)} food logs "
+                f"and the profiles of {len(user_ids)} users")
+
+
+def get_user_stats(limit=100, after_user_id=None):
+    return USER_WINDOWS.users(limit, after_user_id), 200
+
+
+def get_user_stats_over_target(limit=10):
+    return USER_WINDOWS.over_target(limit), 200
+
+
+def get_user_stats_by_id(user_id):
+    user_stats = USER_WINDOWS.user(user_id)
+    if user_stats is None:
+        return {"message": f"No food logged by user {user_id} in the last {max(USER_WINDOWS.windows_days)} days"}, 404
+    return user_stats, 200
+
+
 def healthCheck():
     return NoContent, 200
 
@@ -126,11 +505,16 @@ def init_scheduler():
 
 
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api('calorie-tracker.yml',base_path="/processing",strict_validation=True, validate_responses=True )
+app.add_api('calorie-tracker.yml',base_path="/processing",strict_validation=True, validate_responses=True,
+            pythonic_params=True)
 if "TARGET_ENV" not in os.environ or os.environ["TARGET_ENV"] != "test":
     CORS(app.app)
     app.app.config['CORS_HEADERS'] = 'Content-Type'
 
 if __name__ == "__main__":
-    init_scheduler()
+    fill_user_windows()
+    if STREAM_STATS is not None:
+        init_stream()
+    else:
+        init_scheduler()
     app.run(port=8100)
\ No newline at end of file
@@ -0,0 +1,83 @@
+"""
+Benchmark of the per user rolling totals: Python loops over the readings against
+the grouped pandas sums of user_windows.
+
+Run from the Processing directory: python3 bench_user_windows.py [rows ...] [--users N]
+
+Each size builds that many food log readings spread over the last 7 days, the
+way populate_stats receives them from Storage, and computes every user's 1 and
+7 day totals both ways. The pandas time includes loading the readings into
+columns.
+"""
+import argparse
+import datetime
+import random
+import time
+import uuid
+
+from user_windows import MACROS, TIMESTAMP_FORMAT, UserWindows
+
+WINDOWS_DAYS = [1, 7]
+
+
+def readings(rows, users, now):
+    """ Food log readings with random users, timestamps and nutrients """
+    random.seed(rows)
+    return [{
+        "trace_id": str(uuid.uuid4()),
+        "user_id": random.randrange(users),
+        "timestamp": (now - datetime.timedelta(seconds=random.randrange(7 * 86400))).strftime(TIMESTAMP_FORMAT),
+        "food_name": "Banana",
+        "quantity": 150,
+        "calories": random.randrange(50, 1500),
+        "carbohydrates": random.randrange(100),
+        "fats": random.randrange(50),
+        "proteins": random.randrange(60)
+    } for _ in range(rows)]
+
+
+def totals_loop(food_logs, now):
+    """ The list comprehension style of populate_stats: one pass per window, a dict per user """
+    totals = {}
+    for days in WINDOWS_DAYS:
+        oldest = now - datetime.timedelta(days=days)
+        for reading in food_logs:
+            if datetime.datetime.strptime(reading["timestamp"], TIMESTAMP_FORMAT) <= oldest:
+                continue
+            user_totals = totals.setdefault(reading["user_id"], {}).setdefault(f"{days}d", dict.fromkeys(MACROS, 0))
+            for macro in MACROS:
+                user_totals[macro] += reading[macro]
+    return totals
+
+
+def totals_pandas(food_logs, now):
+    """ The user_windows path """
+    windows = UserWindows(WINDOWS_DAYS)
+    windows.add(food_logs, [], now=now)
+    return windows.totals
+
+
+def timed(compute, *args):
+    """ Seconds one computation takes """
+    started = time.perf_counter()
+    compute(*args)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the per user rolling totals")
+    parser.add_argument("rows", type=int, nargs="*", default=[10000, 100000, 1000000])
+    parser.add_argument("--users", type=int, default=10000, help="distinct users the readings are spread over")
+    args = parser.parse_args()
+
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    print(f"{'rows':>9}{'loop s':>10}{'pandas s':>10}{'speedup':>9}")
+    for rows in args.rows:
+        food_logs = readings(rows, args.users, now)
+        loop_sec = timed(totals_loop, food_logs, now)
+        pandas_sec = timed(totals_pandas, food_logs, now.replace(tzinfo=datetime.timezone.utc))
+        print(f"{rows:>9}{loop_sec:>10.2f}{pandas_sec:>10.2f}{loop_sec / pandas_sec:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Fixed-size summaries of the readings, for the stats that maxima cannot give.
+
+- HyperLogLog: number of distinct user ids, about 1.04/sqrt(2^precision)
+  standard error (1.6% with 4096 registers)
+- DDSketch: percentiles of age, weight and calories, each within
+  relative_accuracy of the true value, in at most max_bins bins
+- SpaceSaving: the most logged food names, out of the capacity names it keeps
+  counts for; a count can be over by at most its reported error
+
+Each one is updated one value at a time, has a bounded size however many
+readings it sees, can be merged with another of the same parameters, and
+serializes to plain JSON so it can be saved with the stats.
+"""
+import base64
+import hashlib
+import math
+
+PERCENTILES = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99}
+
+
+def hash64(value):
+    """ 64 bit hash of a value's string form, the same in every process """
+    return int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog:
+    """ Distinct value counter in 2^precision one-byte registers """
+
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.registers = registers if registers is not None else bytearray(1 << precision)
+
+    def add(self, value):
+        h = hash64(value)
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        # Position of the first 1 bit in the rest of the hash
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLogs of different precisions")
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate while most registers are empty
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_dict(self):
+        return {'precision': self.precision, 'registers': base64.b64encode(bytes(self.registers)).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['precision'], bytearray(base64.b64decode(data['registers'])))
+
+
+class DDSketch:
+    """ Quantile sketch with relative error guarantees, for values >= 0 """
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048, bins=None, zero_count=0):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = bins if bins is not None else {}
+        self.zero_count = zero_count
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.bins.values())
+
+    def add(self, value):
+        if value <= 0:
+            self.zero_count += 1
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.bins[index] = self.bins.get(index, 0) + 1
+        if len(self.bins) > self.max_bins:
+            self.collapse()
+
+    def collapse(self):
+        """ Folds the lowest bins into one, so only the low percentiles lose accuracy """
+        indexes = sorted(self.bins)
+        excess = len(indexes) - self.max_bins + 1
+        folded = sum(self.bins.pop(index) for index in indexes[:excess])
+        self.bins[indexes[excess]] += folded
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge DDSketches of different accuracies")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        if len(self.bins) > self.max_bins:
+            self.collapse()
+
+    def quantile(self, q):
+        """ Value at quantile q (0 to 1), None when the sketch is empty """
+        count = self.count
+        if count == 0:
+            return None
+        rank = q * (count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def percentiles(self):
+        percentiles = {}
+        for name, q in PERCENTILES.items():
+            value = self.quantile(q)
+            percentiles[name] = None if value is None else round(value, 2)
+        return percentiles
+
+    def to_dict(self):
+        return {'relative_accuracy': self.relative_accuracy, 'max_bins': self.max_bins,
+                'zero_count': self.zero_count, 'bins': {str(index): count for index, count in self.bins.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['relative_accuracy'], data['max_bins'],
+                   {int(index): count for index, count in data['bins'].items()}, data['zero_count'])
+
+
+class SpaceSaving:
+    """ Heavy hitters: counts for at most capacity items, each with the most it may be over by """
+
+    def __init__(self, capacity=100, counters=None):
+        self.capacity = capacity
+        # item -> [count, error]
+        self.counters = counters if counters is not None else {}
+
+    def add(self, item):
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += 1
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[item] = [1, 0]
+            return
+        # The new item takes over the smallest counter, which bounds how many times it was missed
+        smallest = min(self.counters, key=lambda key: self.counters[key][0])
+        count = self.counters.pop(smallest)[0]
+        self.counters[item] = [count + 1, count]
+
+    def min_count(self):
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(counter[0] for counter in self.counters.values())
+
+    def merge(self, other):
+        """ Items missing from one side may have had up to that side's smallest count """
+        own_min, other_min = self.min_count(), other.min_count()
+        merged = {}
+        for item in set(self.counters) | set(other.counters):
+            count, error = self.counters.get(item, [own_min, own_min])
+            other_count, other_error = other.counters.get(item, [other_min, other_min])
+            merged[item] = [count + other_count, error + other_error]
+        kept = sorted(merged, key=lambda item: merged[item][0], reverse=True)[:self.capacity]
+        self.counters = {item: merged[item] for item in kept}
+
+    def top(self, n):
+        items = sorted(self.counters.items(), key=lambda item: item[1][0], reverse=True)[:n]
+        return [{'name': item, 'count': count, 'error': error} for item, (count, error) in items]
+
+    def to_dict(self):
+        return {'capacity': self.capacity, 'counters': self.counters}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['capacity'], {item: list(counter) for item, counter in data['counters'].items()})
+
+
+class ReadingSketches:
+    """ Every sketch of the Processing stats """
+
+    def __init__(self, config, users=None, ages=None, weights=None, calories=None, foods=None):
+        self.config = config
+        self.users = users or HyperLogLog(config['hll_precision'])
+        self.ages = ages or DDSketch(config['relative_accuracy'], config['max_bins'])
+        self.weights = weights or DDSketch(config['relative_accuracy'], config['max_bins'])
+        self.calories = calories or DDSketch(config['relative_accuracy'], config['max_bins'])
+        self.foods = foods or SpaceSaving(config['top_foods_capacity'])
+
+    def add_personal_info(self, reading):
+        self.users.add(reading['user_id'])
+        self.ages.add(float(reading['age']))
+        self.weights.add(float(reading['weight']))
+
+    def add_food_log(self, reading):
+        self.calories.add(float(reading['calories']))
+        self.foods.add(reading['food_name'])
+
+    def merge(self, other):
+        self.users.merge(other.users)
+        self.ages.merge(other.ages)
+        self.weights.merge(other.weights)
+        self.calories.merge(other.calories)
+        self.foods.merge(other.foods)
+
+    def summary(self):
+        """ The ReadingStats fields the sketches provide """
+        return {
+            'distinct_users': self.users.count(),
+            'age_percentiles': self.ages.percentiles(),
+            'weight_percentiles': self.weights.percentiles(),
+            'calories_percentiles': self.calories.percentiles(),
+            'top_foods': [{'food_name': food['name'], 'count': food['count']}
+                          for food in self.foods.top(self.config['top_foods'])]
+        }
+
+    def to_dict(self):
+        return {'users': self.users.to_dict(), 'ages': self.ages.to_dict(), 'weights': self.weights.to_dict(),
+                'calories': self.calories.to_dict(), 'foods': self.foods.to_dict()}
+
+    @classmethod
+    def from_dict(cls, config, data):
+        """ Sketches saved with to_dict, or empty ones for stats saved before there were any """
+        if not data:
+            return cls(config)
+        return cls(config,
+                   HyperLogLog.from_dict(data['users']),
+                   DDSketch.from_dict(data['ages']),
+                   DDSketch.from_dict(data['weights']),
+                   DDSketch.from_dict(data['calories']),
+                   SpaceSaving.from_dict(data['foods']))
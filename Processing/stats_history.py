@@ -0,0 +1,118 @@
+"""
+What the stats did over time, at several resolutions (e.g. per minute, hour and day).
+
+Each resolution is a ring of a fixed number of buckets held in arrays, one per
+column: the bucket's start, the personal info and food log counts in it, and
+its maxima. A reading's counts go to the bucket covering its time at every
+resolution at once, so the hour and day buckets are the roll-up of the minute
+ones and outlive them. A slot whose start is not the bucket wanted is stale
+(its time came round the ring again) and is reset before being reused.
+
+Memory and the saved size only depend on the number of buckets, and a history
+query touches one slot per bucket in its range.
+"""
+import base64
+import math
+import struct
+from array import array
+from threading import Lock
+
+COUNTS = ('num_users', 'num_food_log')
+MAXIMA = ('max_age', 'max_weight', 'max_calories')
+LEVEL_HEADER = struct.Struct('>II')
+
+
+class Level:
+    """ Ring of buckets of one resolution """
+
+    def __init__(self, width_sec, buckets):
+        self.width_sec = width_sec
+        self.buckets = buckets
+        self.starts = array('q', [-1]) * buckets
+        self.counts = {name: array('q', [0]) * buckets for name in COUNTS}
+        self.maxima = {name: array('d', [math.nan]) * buckets for name in MAXIMA}
+
+    def slot(self, start):
+        """ Index of the bucket starting at start, emptied if it held an older one """
+        i = (start // self.width_sec) % self.buckets
+        if self.starts[i] != start:
+            self.starts[i] = start
+            for column in self.counts.values():
+                column[i] = 0
+            for column in self.maxima.values():
+                column[i] = math.nan
+        return i
+
+    def add(self, epoch, counts, maxima):
+        i = self.slot(int(epoch) // self.width_sec * self.width_sec)
+        for name, value in counts.items():
+            self.counts[name][i] += value
+        for name, value in maxima.items():
+            if value is not None and not value <= self.maxima[name][i]:
+                self.maxima[name][i] = value
+
+    def bucket(self, start):
+        """ Deltas of the bucket starting at start; empty ones when it is not held """
+        i = (start // self.width_sec) % self.buckets
+        held = self.starts[i] == start
+        bucket = {'start': start}
+        for name, column in self.counts.items():
+            bucket[name] = column[i] if held else 0
+        for name, column in self.maxima.items():
+            bucket[name] = None if not held or math.isnan(column[i]) else column[i]
+        return bucket
+
+    def to_bytes(self):
+        columns = [self.starts] + list(self.counts.values()) + list(self.maxima.values())
+        return LEVEL_HEADER.pack(self.width_sec, self.buckets) + b''.join(column.tobytes() for column in columns)
+
+    def load(self, data, offset):
+        """ Fills the arrays from to_bytes() output, whose columns start at offset """
+        for column in [self.starts] + list(self.counts.values()) + list(self.maxima.values()):
+            size = column.itemsize * self.buckets
+            column[:] = array(column.typecode, data[offset:offset + size])
+            offset += size
+
+
+class StatsHistory:
+    """ A Level per configured resolution, e.g. {'minute': {'width_sec': 60, 'buckets': 1440}} """
+
+    def __init__(self, resolutions):
+        self.levels = {name: Level(resolution['width_sec'], resolution['buckets'])
+                       for name, resolution in resolutions.items()}
+        self.lock = Lock()
+
+    def add(self, epoch, counts, maxima):
+        """ Adds counts (e.g. {'num_food_log': 3}) and maxima at a time, at every resolution """
+        with self.lock:
+            for level in self.levels.values():
+                level.add(epoch, counts, maxima)
+
+    def buckets(self, resolution, start, end):
+        """ Every bucket of a resolution overlapping [start, end), at most the ones it keeps """
+        level = self.levels[resolution]
+        first = max(start // level.width_sec, end // level.width_sec - level.buckets + 1) * level.width_sec
+        with self.lock:
+            return [level.bucket(bucket_start) for bucket_start in range(first, end, level.width_sec)]
+
+    def encode(self):
+        """ Compact form to save with the stats: the arrays' bytes, base64 encoded """
+        with self.lock:
+            return base64.b64encode(b''.join(level.to_bytes() for level in self.levels.values())).decode('ascii')
+
+    def decode(self, encoded):
+        """ Loads a saved history, unless the resolutions were changed since; returns whether it was loaded """
+        data = base64.b64decode(encoded)
+        offsets = []
+        offset = 0
+        for level in self.levels.values():
+            if data[offset:offset + LEVEL_HEADER.size] != LEVEL_HEADER.pack(level.width_sec, level.buckets):
+                return False
+            offsets.append(offset + LEVEL_HEADER.size)
+            offset += LEVEL_HEADER.size + level.buckets * 8 * (1 + len(COUNTS) + len(MAXIMA))
+        if offset != len(data):
+            return False
+        with self.lock:
+            for level, offset in zip(self.levels.values(), offsets):
+                level.load(data, offset)
+        return True
@@ -0,0 +1,100 @@
+"""
+Processing stats kept up to date from the events topic itself.
+
+With stats.source: stream, Processing consumes the events topic under its own
+consumer group and folds each event into the stats as it arrives, instead of
+asking Storage for every reading since last_updated every period. The stats
+are checkpointed together with the last offset applied on each partition, in
+one file that is replaced atomically, so after a restart consumption resumes
+right after the events the saved stats include: none is counted twice or lost.
+
+max_* are the maxima over every event consumed, where the polling mode reports
+those of its latest window. The sketches and the history (each event counted
+in the buckets of its datetime) are checkpointed with the stats.
+"""
+import datetime
+import json
+import logging
+import os
+from threading import Lock
+import envelope
+import snapshot
+from sketches import ReadingSketches
+from stats_history import StatsHistory
+
+logger = logging.getLogger('basicLogger')
+
+EMPTY_STATS = {
+    'num_users': 0,
+    'max_age': 0,
+    'max_weight': 0,
+    'num_food_log': 0,
+    'max_calories': 0,
+    'last_updated': "2000-01-01T00:00:00Z"
+}
+
+
+def read_checkpoint(filename):
+    """ Saved stats and offsets, or empty ones when nothing was checkpointed yet """
+    if not os.path.isfile(filename):
+        return {'stats': dict(EMPTY_STATS), 'offsets': {}, 'sketches': None, 'history': None}
+    with open(filename) as f:
+        checkpoint = json.load(f)
+    # JSON object keys are strings
+    checkpoint['offsets'] = {int(partition_id): offset for partition_id, offset in checkpoint['offsets'].items()}
+    return checkpoint
+
+
+def write_checkpoint(filename, checkpoint):
+    """ Replaces the checkpoint file, so a crash leaves either the old or the new one """
+    snapshot.write_atomically(filename, checkpoint)
+
+
+class StreamStats:
+    """ Stats folded from the events consumed, with the offset reached on each partition """
+
+    def __init__(self, filename, sketch_config, history_resolutions):
+        self.filename = filename
+        checkpoint = read_checkpoint(filename)
+        self.stats = checkpoint['stats']
+        self.offsets = checkpoint['offsets']
+        self.sketches = ReadingSketches.from_dict(sketch_config, checkpoint.get('sketches'))
+        self.history = StatsHistory(history_resolutions)
+        if checkpoint.get('history') and not self.history.decode(checkpoint['history']):
+            logger.warning("The checkpointed history has other resolutions than configured, starting a new one")
+        self.lock = Lock()
+
+    def apply(self, event, partition_id, offset):
+        """ Adds one event to the stats; event is None for a message that could not be decoded """
+        with self.lock:
+            if event is not None:
+                payload = event['payload']
+                if event['type'] == 'personal_info':
+                    self.stats['num_users'] += 1
+                    self.stats['max_age'] = max(self.stats['max_age'], payload['age'])
+                    self.stats['max_weight'] = max(self.stats['max_weight'], payload['weight'])
+                    self.sketches.add_personal_info(payload)
+                    self.history.add(envelope.parse_datetime(event['datetime']), {'num_users': 1},
+                                     {'max_age': payload['age'], 'max_weight': payload['weight']})
+                elif event['type'] == 'food_log':
+                    self.stats['num_food_log'] += 1
+                    self.stats['max_calories'] = max(self.stats['max_calories'], payload['calories'])
+                    self.sketches.add_food_log(payload)
+                    self.history.add(envelope.parse_datetime(event['datetime']), {'num_food_log': 1},
+                                     {'max_calories': payload['calories']})
+            self.offsets[partition_id] = offset
+
+    def snapshot(self):
+        """ Current stats, as of the last event consumed """
+        with self.lock:
+            stats = dict(self.stats, **self.sketches.summary())
+        stats['last_updated'] = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
+        return stats
+
+    def checkpoint(self):
+        """ Saves the stats with the offsets they include """
+        with self.lock:
+            checkpoint = {'stats': dict(self.stats), 'offsets': dict(self.offsets),
+                          'sketches': self.sketches.to_dict(), 'history': self.history.encode()}
+        checkpoint['stats']['last_updated'] = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
+        write_checkpoint(self.filename, checkpoint)
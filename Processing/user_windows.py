@@ -0,0 +1,159 @@
+"""
+Each user's calorie and macro totals over rolling windows (e.g. the last 1 and
+7 days), and how far they are over their daily calorie target.
+
+The food log readings of the longest window are kept in a pandas DataFrame
+and each user's latest profile in another. New readings are added a batch at a
+time (a poll's window, or the events between two stream checkpoints) with one
+concat, rows that left the longest window are dropped, and every user's totals
+are recomputed with grouped sums over the columns instead of Python loops over
+the rows. Readings are keyed by trace_id, so adding one twice changes nothing.
+
+A user's daily calorie target is their Mifflin-St Jeor basal metabolic rate
+times their activity level's factor, less 500 kcal to lose weight or plus 500
+to gain it. calories_over_target is their average daily calories over the
+longest window less that target.
+
+Nothing is saved: on start the windows are filled from Storage's readings.
+"""
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+
+MACROS = ['calories', 'carbohydrates', 'fats', 'proteins']
+FOOD_LOG_COLUMNS = ['trace_id', 'user_id', 'timestamp'] + MACROS
+PROFILE_COLUMNS = ['user_id', 'age', 'sex', 'height', 'weight', 'activity_level', 'nutritional_goal']
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+ACTIVITY_FACTORS = {
+    'sedentary': 1.2,
+    'light': 1.375,
+    'lightly active': 1.375,
+    'moderate': 1.55,
+    'moderately active': 1.55,
+    'active': 1.725,
+    'very active': 1.9,
+}
+# Activity levels not listed above
+DEFAULT_ACTIVITY_FACTOR = 1.55
+GOAL_ADJUSTMENT = 500
+
+
+def food_log_frame(readings):
+    """ Food log readings (Storage rows or event payloads) as columns, without unparseable timestamps """
+    frame = pd.DataFrame.from_records(readings, columns=FOOD_LOG_COLUMNS)
+    # Without the trailing Z the format is plain ISO 8601, which pandas parses several times faster
+    timestamps = frame['timestamp'].astype(str).str[:19]
+    frame['timestamp'] = pd.to_datetime(timestamps, format='%Y-%m-%dT%H:%M:%S', utc=True, errors='coerce')
+    for column in ['user_id'] + MACROS:
+        frame[column] = pd.to_numeric(frame[column], errors='coerce')
+    return frame.dropna()
+
+
+def profile_frame(readings):
+    """ Personal info readings as columns """
+    frame = pd.DataFrame.from_records(readings, columns=PROFILE_COLUMNS)
+    for column in ('user_id', 'age', 'height', 'weight'):
+        frame[column] = pd.to_numeric(frame[column], errors='coerce')
+    return frame.dropna(subset=['user_id'])
+
+
+def calorie_targets(profiles):
+    """ Daily calorie target of every user with a profile, indexed by user_id """
+    sex = profiles['sex'].str.lower()
+    bmr = (10 * profiles['weight'] + 6.25 * profiles['height'] - 5 * profiles['age']
+           + np.where(sex == 'male', 5, np.where(sex == 'female', -161, -78)))
+    factor = profiles['activity_level'].str.lower().str.strip().map(ACTIVITY_FACTORS).fillna(DEFAULT_ACTIVITY_FACTOR)
+    goal = profiles['nutritional_goal'].str.lower()
+    adjustment = np.select([goal.str.contains('lose', na=False), goal.str.contains('gain', na=False)],
+                           [-GOAL_ADJUSTMENT, GOAL_ADJUSTMENT], 0)
+    return pd.Series((bmr * factor + adjustment).values, index=profiles['user_id'].astype('int64'))
+
+
+class UserWindows:
+    """ Rolling per user totals, recomputed whenever readings are added """
+
+    def __init__(self, windows_days):
+        self.windows_days = sorted(windows_days)
+        self.food_logs = food_log_frame([])
+        self.profiles = profile_frame([])
+        self.totals = pd.DataFrame()
+        self.as_of = None
+        self.lock = Lock()
+
+    def add(self, food_logs, profiles, now=None):
+        """ Adds a batch of readings and recomputes the totals as of now """
+        now = now or pd.Timestamp.now(tz='UTC')
+        added_food_logs = food_log_frame(food_logs)
+        added_profiles = profile_frame(profiles)
+
+        oldest = now - pd.Timedelta(days=self.windows_days[-1])
+        kept = pd.concat([self.food_logs, added_food_logs], ignore_index=True)
+        kept = kept[kept['timestamp'] > oldest].drop_duplicates('trace_id')
+        # Profiles come in the order they were stored, so the last one is the current one
+        latest_profiles = pd.concat([self.profiles, added_profiles], ignore_index=True)
+        latest_profiles = latest_profiles.drop_duplicates('user_id', keep='last')
+
+        totals = self.compute(kept, latest_profiles, now)
+        with self.lock:
+            self.food_logs = kept
+            self.profiles = latest_profiles
+            self.totals = totals
+            self.as_of = now
+
+    def compute(self, food_logs, profiles, now):
+        """ One row per user: <macro>_<n>d and entries_<n>d per window, target and how far over it """
+        columns = []
+        for days in self.windows_days:
+            recent = food_logs[food_logs['timestamp'] > now - pd.Timedelta(days=days)]
+            grouped = recent.groupby('user_id')
+            sums = grouped[MACROS].sum()
+            sums['entries'] = grouped.size()
+            columns.append(sums.add_suffix(f'_{days}d'))
+        totals = pd.concat(columns, axis=1).fillna(0)
+        totals.index = totals.index.astype('int64')
+
+        longest = self.windows_days[-1]
+        totals['target_calories'] = calorie_targets(profiles).reindex(totals.index)
+        totals['calories_over_target'] = totals[f'calories_{longest}d'] / longest - totals['target_calories']
+        return totals.sort_index()
+
+    def to_dict(self, user_id, row):
+        """ UserNutrition response of one row of the totals """
+        def number(value):
+            return None if pd.isna(value) else round(float(value), 1)
+
+        return {
+            'user_id': int(user_id),
+            'as_of': self.as_of.strftime(TIMESTAMP_FORMAT),
+            'windows': {f'{days}d': {'entries': int(row[f'entries_{days}d']),
+                                     **{macro: int(row[f'{macro}_{days}d']) for macro in MACROS}}
+                        for days in self.windows_days},
+            'target_calories': number(row['target_calories']),
+            'calories_over_target': number(row['calories_over_target'])
+        }
+
+    def user(self, user_id):
+        """ One user's totals, None when they logged nothing in the longest window """
+        with self.lock:
+            if user_id not in self.totals.index:
+                return None
+            return self.to_dict(user_id, self.totals.loc[user_id])
+
+    def users(self, limit, after_user_id=None):
+        """ Totals of every user, in user_id order """
+        with self.lock:
+            totals = self.totals
+            if after_user_id is not None:
+                totals = totals[totals.index > after_user_id]
+            return [self.to_dict(user_id, row) for user_id, row in totals.head(limit).iterrows()]
+
+    def over_target(self, limit):
+        """ The users furthest over their calorie target """
+        with self.lock:
+            if self.totals.empty:
+                return []
+            furthest = self.totals.dropna(subset=['calories_over_target'])
+            furthest = furthest.sort_values('calories_over_target', ascending=False).head(limit)
+            return [self.to_dict(user_id, row) for user_id, row in furthest.iterrows()]
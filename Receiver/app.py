@@ -4,10 +4,13 @@ import yaml
 import logging.config
 import uuid
 from pykafka import KafkaClient
+from pykafka.partitioners import hashing_partitioner
 import datetime
-import json
 import time
 import os
+from queue import Empty, Full
+from async_producer import AsyncProducer
+import envelope
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
@@ -29,6 +32,13 @@ logger = logging.getLogger('basicLogger')
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
+ASYNC_MODE = app_config['kafka'].get('producer_mode', 'sync') == 'async'
+
+def user_partitioner(partitions, key):
+    """Pick the partition from the user_id key so each user's events stay in order."""
+    # Sort so the mapping does not depend on the order the broker listed the partitions in
+    return hashing_partitioner(sorted(partitions, key=lambda partition: partition.id), key)
+
 def get_kafka():
     retry_count = 0
     max_retries = app_config['kafka']['max_retries']
@@ -39,9 +49,32 @@ def get_kafka():
             logger.info(f"Trying to connect to Kafka, attempt {retry_count+1}")
             client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
             kafka_topic = client.topics[str.encode(app_config['events']['topic'])]
-            producer = kafka_topic.get_sync_producer()
+            if len(kafka_topic.partitions) != app_config['events']['partitions']:
+                logger.warning(f"Topic has {len(kafka_topic.partitions)} partitions, "
+                               f"expected {app_config['events']['partitions']}")
+            if ASYNC_MODE:
+                # Requests only enqueue; a sender thread produces with linger/batching
+                # and records which trace IDs failed delivery
+                producer = AsyncProducer(
+                    kafka_topic.get_producer(delivery_reports=True,
+                                             partitioner=user_partitioner,
+                                             linger_ms=app_config['kafka']['linger_ms'],
+                                             min_queued_messages=app_config['kafka']['min_queued_messages'],
+                                             max_queued_messages=app_config['kafka']['max_in_flight'],
+                                             block_on_queue_full=False),
+                    app_config['kafka']['max_in_flight'],
+                    app_config['kafka']['failures_kept'])
+                batch_producer = None
+            else:
+                producer = kafka_topic.get_sync_producer(partitioner=user_partitioner)
+                # Batches are produced without waiting on each message, then the delivery
+                # reports are collected, so a whole batch costs roughly one round trip
+                batch_producer = kafka_topic.get_producer(delivery_reports=True,
+                                                          partitioner=user_partitioner,
+                                                          min_queued_messages=1,
+                                                          linger_ms=0)
             logger.info("Connected to Kafka successfully")
-            return client, producer
+            return client, producer, batch_producer
             
         except Exception as e:
             logger.error(f"Connection to Kafka failed: {str(e)}")
@@ -49,40 +82,158 @@ def get_kafka():
             retry_count += 1
     raise Exception("Failed to connect to Kafka after retries")
 
-client, producer = get_kafka()
+client, producer, batch_producer = get_kafka()
 
 def generate_trace_id():
     """Generate a unique trace ID using UUID4 for correlating events across different systems."""
     return str(uuid.uuid4())
 
+def partition_key(body):
+    """Key events by user so all of a user's events land on the same partition."""
+    return str(body["user_id"]).encode('utf-8')
+
 def send_kafka(event_type, body):
     """Send an event to a specified Kafka topic."""
 
     msg = {
         "type": event_type,
         "datetime": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        # Start of the event's end-to-end latency, see Audit's /trace
+        "received_at_ms": int(time.time() * 1000),
         "payload": body
     }
 
     # Send the message to the Kafka topic
-    msg_str = json.dumps(msg)
-    producer.produce(msg_str.encode('utf-8'))
+    msg_bytes = envelope.encode(msg, app_config['events']['encoding'])
+    if ASYNC_MODE:
+        producer.submit(body["trace_id"], msg_bytes, partition_key(body))
+    else:
+        producer.produce(msg_bytes, partition_key=partition_key(body))
+
+def busy_response():
+    """Fast rejection used when too many events are waiting for Kafka."""
+    retry_after = app_config['kafka']['retry_after_sec']
+    return {"message": "Too many events in flight, retry later"}, 503, {"Retry-After": str(retry_after)}
+
+def send_kafka_batch(event_type, bodies):
+    """Send a batch of events to Kafka in one pipelined produce and report the status of each."""
+    if ASYNC_MODE:
+        return queue_kafka_batch(event_type, bodies)
+
+    now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+    results = []
+    pending = {}
+
+    for index, body in enumerate(bodies):
+        traceid = generate_trace_id()
+        body["trace_id"] = traceid
+        results.append({"index": index, "trace_id": traceid, "status": 201})
+
+        msg = {
+            "type": event_type,
+            "datetime": now,
+            "received_at_ms": int(time.time() * 1000),
+            "payload": body
+        }
+        try:
+            produced = batch_producer.produce(envelope.encode(msg, app_config['events']['encoding']),
+                                              partition_key=partition_key(body))
+            pending[id(produced)] = (index, produced)
+        except Exception as e:
+            logger.error(f"Failed to queue {event_type} event with trace ID {traceid}: {str(e)}")
+            results[index].update(status=503, error=str(e))
+
+    deadline = time.time() + app_config['batch']['delivery_timeout_sec']
+    while pending:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            reported, exc = batch_producer.get_delivery_report(timeout=remaining)
+        except Empty:
+            break
+        index, _ = pending.pop(id(reported), (None, None))
+        if index is not None and exc is not None:
+            logger.error(f"Delivery failed for trace ID {results[index]['trace_id']}: {str(exc)}")
+            results[index].update(status=503, error=str(exc))
+
+    for index, _ in pending.values():
+        results[index].update(status=504, error="Timed out waiting for delivery report")
+
+    return results
+
+def queue_kafka_batch(event_type, bodies):
+    """Hand a batch of events to the async producer, rejecting the ones that do not fit."""
+    results = []
+    for index, body in enumerate(bodies):
+        traceid = generate_trace_id()
+        body["trace_id"] = traceid
+        try:
+            send_kafka(event_type, body)
+            results.append({"index": index, "trace_id": traceid, "status": 202})
+        except Full:
+            results.append({"index": index, "trace_id": traceid, "status": 503,
+                            "error": "Too many events in flight, retry later"})
+    return results
+
+def batch_response(event_type, results):
+    """Summarise per-item batch results; 201/202 when every event was accepted, 207 otherwise."""
+    ok_status = 202 if ASYNC_MODE else 201
+    failed = sum(1 for result in results if result["status"] != ok_status)
+    logger.info(f"Sent {len(results) - failed} of {len(results)} {event_type} events in batch")
+    if ASYNC_MODE and failed == len(results):
+        return busy_response()
+    body = {
+        "accepted": len(results) - failed,
+        "failed": failed,
+        "results": results
+    }
+    return body, ok_status if failed == 0 else 207
 
 def PersonalInfo(body):
     """Handle incoming Personal Info event by sending it to Kafka."""
     traceid = generate_trace_id()
     body["trace_id"] = traceid
     logger.info(f"Received Personal Info event with trace ID: {traceid}")
-    send_kafka("personal_info", body)
-    return NoContent, 201
+    try:
+        send_kafka("personal_info", body)
+    except Full:
+        logger.warning(f"Rejected event with trace ID {traceid}, too many events in flight")
+        return busy_response()
+    return NoContent, 202 if ASYNC_MODE else 201
 
 def FoodLog(body):
     """ Handle incoming Food Log event by sending it to Kafka. """
     traceid = generate_trace_id()
     body["trace_id"] = traceid
     logger.info(f"Received Food Log event with trace ID: {traceid}")
-    send_kafka("food_log", body)
-    return NoContent, 201
+    try:
+        send_kafka("food_log", body)
+    except Full:
+        logger.warning(f"Rejected event with trace ID {traceid}, too many events in flight")
+        return busy_response()
+    return NoContent, 202 if ASYNC_MODE else 201
+
+def PersonalInfoBatch(body):
+    """Handle a batch of Personal Info events by sending them to Kafka together."""
+    logger.info(f"Received batch of {len(body)} Personal Info events")
+    return batch_response("personal_info", send_kafka_batch("personal_info", body))
+
+def FoodLogBatch(body):
+    """Handle a batch of Food Log events by sending them to Kafka together."""
+    logger.info(f"Received batch of {len(body)} Food Log events")
+    return batch_response("food_log", send_kafka_batch("food_log", body))
+
+def get_delivery_failures():
+    """Report the trace IDs that the async producer failed to deliver."""
+    if not ASYNC_MODE:
+        return {"message": "Delivery failures are only tracked in async producer mode"}, 404
+    return {
+        "in_flight": producer.in_flight,
+        "delivered_total": producer.delivered_total,
+        "failed_total": producer.failed_total,
+        "failures": producer.get_failures()
+    }, 200
 
 
 def healthCheck():
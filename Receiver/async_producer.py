@@ -0,0 +1,102 @@
+import logging
+import threading
+import datetime
+from collections import deque
+from queue import Queue, Empty, Full
+
+logger = logging.getLogger('basicLogger')
+
+
+class AsyncProducer:
+    """ Bounded, non-blocking front end for a delivery-reporting pykafka producer """
+
+    def __init__(self, producer, max_in_flight, failures_kept, poll_sec=0.01):
+        """ Starts the sender thread that owns the producer and its delivery reports """
+        self.producer = producer
+        self.max_in_flight = max_in_flight
+        self.poll_sec = poll_sec
+        self.in_flight = 0
+        self.queue = Queue()
+        self.pending = {}
+        self.failures = deque(maxlen=failures_kept)
+        self.failed_total = 0
+        self.delivered_total = 0
+        self.lock = threading.Lock()
+
+        # pykafka delivery reports are thread-local, so the same thread must
+        # both produce and collect them
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, trace_id, value, partition_key=None):
+        """ Queues a message for sending, raising queue.Full if too many are in flight """
+        with self.lock:
+            if self.in_flight >= self.max_in_flight:
+                raise Full()
+            self.in_flight += 1
+        self.queue.put((trace_id, value, partition_key))
+
+    def get_failures(self):
+        """ Recent delivery failures, oldest first """
+        with self.lock:
+            return list(self.failures)
+
+    def run(self):
+        """ Produces queued messages and collects their delivery reports """
+        while True:
+            try:
+                item = self.queue.get(timeout=self.poll_sec)
+            except Empty:
+                item = None
+
+            while item is not None:
+                self.produce(*item)
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    item = None
+
+            self.collect_reports()
+
+    def produce(self, trace_id, value, partition_key):
+        """ Hands one message to the pykafka producer """
+        try:
+            msg = self.producer.produce(value, partition_key=partition_key)
+            self.pending[id(msg)] = (trace_id, msg)
+        except Exception as e:
+            self.record_failure(trace_id, e)
+
+    def collect_reports(self):
+        """ Drains delivery reports without blocking """
+        while self.pending:
+            try:
+                reported, exc = self.producer.get_delivery_report(block=False)
+            except Empty:
+                return
+            trace_id, _ = self.pending.pop(id(reported), (None, None))
+            if trace_id is None:
+                continue
+            if exc is not None:
+                self.record_failure(trace_id, exc)
+            else:
+                self.release(delivered=True)
+
+    def record_failure(self, trace_id, exc):
+        """ Remembers a trace ID that could not be delivered and frees its slot """
+        logger.error(f"Delivery failed for trace ID {trace_id}: {str(exc)}")
+        with self.lock:
+            self.failures.append({
+                "trace_id": trace_id,
+                "error": str(exc),
+                "failed_at": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+            })
+        self.release(delivered=False)
+
+    def release(self, delivered):
+        """ Frees the in-flight slot of a message that has been acknowledged or failed """
+        with self.lock:
+            self.in_flight -= 1
+            if delivered:
+                self.delivered_total += 1
+            else:
+                self.failed_total += 1
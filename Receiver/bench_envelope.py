@@ -0,0 +1,63 @@
+"""
+Micro-benchmark of the JSON and binary event envelopes.
+
+Run from the Receiver directory: python3 bench_envelope.py [iterations]
+"""
+import sys
+import timeit
+import uuid
+
+import envelope
+
+FOOD_LOG = {
+    "type": "food_log",
+    "datetime": "2023-11-23T15:30:45Z",
+    "payload": {
+        "trace_id": str(uuid.uuid4()),
+        "user_id": 1234,
+        "timestamp": "2023-11-23T15:30:00Z",
+        "food_name": "Banana",
+        "quantity": 150,
+        "calories": 105,
+        "carbohydrates": 27,
+        "fats": 15,
+        "proteins": 40
+    }
+}
+
+PERSONAL_INFO = {
+    "type": "personal_info",
+    "datetime": "2023-11-23T15:30:45Z",
+    "payload": {
+        "trace_id": str(uuid.uuid4()),
+        "user_id": 1234,
+        "age": 30,
+        "sex": "female",
+        "height": 170,
+        "weight": 65,
+        "activity_level": "Moderate",
+        "nutritional_goal": "Maintain weight"
+    }
+}
+
+
+def bench(msg, encoding, iterations):
+    """ Returns (bytes, encode us/op, decode us/op) for one envelope encoding """
+    raw = envelope.encode(msg, encoding)
+    assert envelope.decode(raw) == msg
+    encode_time = timeit.timeit(lambda: envelope.encode(msg, encoding), number=iterations)
+    decode_time = timeit.timeit(lambda: envelope.decode(raw), number=iterations)
+    return len(raw), encode_time / iterations * 1e6, decode_time / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f"{'event':<15}{'encoding':<10}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for msg in (FOOD_LOG, PERSONAL_INFO):
+        for encoding in ("json", "binary"):
+            size, encode_us, decode_us = bench(msg, encoding, iterations)
+            print(f"{msg['type']:<15}{encoding:<10}{size:>8}{encode_us:>12.2f}{decode_us:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
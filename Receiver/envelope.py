@@ -0,0 +1,130 @@
+"""
+Encoding of the event envelope sent on the events topic.
+
+An envelope is {"type": ..., "datetime": ..., "received_at_ms": ..., "payload": {...}},
+received_at_ms being when the Receiver produced it (epoch milliseconds, left
+out by older producers). It is sent either as JSON or as a compact binary record:
+
+    version (1 byte) | type (1 byte) | datetime (uint32 epoch seconds)
+    | received_at_ms (uint64, 0 when unknown) | trace_id (16 bytes)
+    | fixed-width integer fields | length-prefixed UTF-8 string fields
+
+Version 1 records have no received_at_ms and are still decoded. JSON envelopes
+always start with '{', binary ones with the version byte, so consumers can read
+both kinds from the same topic.
+"""
+import calendar
+import json
+import struct
+import time
+
+VERSION = 2
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+HEADER = struct.Struct('>BBIQ16s')
+# Records written before received_at_ms
+HEADER_V1 = struct.Struct('>BBI16s')
+STRING_LENGTH = struct.Struct('>H')
+
+# type code -> (event type, integer fields and their layout, string fields)
+LAYOUTS = {
+    1: ("food_log",
+        ("user_id", "quantity", "calories", "carbohydrates", "fats", "proteins"),
+        struct.Struct('>qiiiii'),
+        ("timestamp", "food_name")),
+    2: ("personal_info",
+        ("user_id", "age", "height", "weight"),
+        struct.Struct('>qiii'),
+        ("sex", "activity_level", "nutritional_goal")),
+}
+TYPE_CODES = {layout[0]: code for code, layout in LAYOUTS.items()}
+
+
+def encode(msg, encoding="json"):
+    """ Encodes an envelope, falling back to JSON when it does not fit the binary layout """
+    if encoding == "binary":
+        try:
+            return encode_binary(msg)
+        except (KeyError, ValueError, TypeError, struct.error):
+            pass
+    return json.dumps(msg).encode('utf-8')
+
+
+def encode_binary(msg):
+    """ Encodes an envelope with the fixed binary layout """
+    code = TYPE_CODES[msg["type"]]
+    _, int_fields, int_layout, str_fields = LAYOUTS[code]
+    payload = msg["payload"]
+
+    # Anything the layout cannot carry has to go as JSON so no field is lost
+    if set(payload) != {"trace_id"} | set(int_fields) | set(str_fields):
+        raise ValueError("Payload fields do not match the binary layout")
+    if not all(type(payload[field]) is int for field in int_fields):
+        raise TypeError("Integer field with a non-integer value")
+
+    parts = [HEADER.pack(VERSION, code, parse_datetime(msg["datetime"]), msg.get("received_at_ms", 0),
+                         trace_id_to_bytes(payload["trace_id"])),
+             int_layout.pack(*[payload[field] for field in int_fields])]
+    for field in str_fields:
+        value = payload[field].encode('utf-8')
+        parts.append(STRING_LENGTH.pack(len(value)))
+        parts.append(value)
+    return b''.join(parts)
+
+
+def parse_datetime(value):
+    """ Converts a YYYY-MM-DDTHH:MM:SSZ string to epoch seconds (strptime is several times slower) """
+    if len(value) != 20 or value[4] != '-' or value[10] != 'T' or value[19] != 'Z':
+        raise ValueError(f"Unexpected datetime format {value}")
+    return calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                            int(value[11:13]), int(value[14:16]), int(value[17:19])))
+
+
+def trace_id_to_bytes(trace_id):
+    """ Packs a canonical UUID string into 16 bytes """
+    if len(trace_id) != 36:
+        raise ValueError(f"Trace ID {trace_id} is not a canonical UUID")
+    packed = bytes.fromhex(trace_id.replace('-', ''))
+    if trace_id_from_bytes(packed) != trace_id:
+        raise ValueError(f"Trace ID {trace_id} is not a canonical UUID")
+    return packed
+
+
+def trace_id_from_bytes(packed):
+    """ Formats 16 bytes as a canonical UUID string """
+    h = packed.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def decode(raw):
+    """ Decodes a JSON or binary envelope into its dictionary form """
+    if raw[:1] == b'{':
+        return json.loads(raw.decode('utf-8'))
+    if raw[0] == VERSION:
+        _, code, created, received_at_ms, trace_id = HEADER.unpack_from(raw)
+        offset = HEADER.size
+    elif raw[0] == 1:
+        _, code, created, trace_id = HEADER_V1.unpack_from(raw)
+        received_at_ms = 0
+        offset = HEADER_V1.size
+    else:
+        raise ValueError(f"Unknown event envelope version {raw[0]}")
+    event_type, int_fields, int_layout, str_fields = LAYOUTS[code]
+
+    payload = {"trace_id": trace_id_from_bytes(trace_id)}
+    payload.update(zip(int_fields, int_layout.unpack_from(raw, offset)))
+    offset += int_layout.size
+    for field in str_fields:
+        (length,) = STRING_LENGTH.unpack_from(raw, offset)
+        offset += STRING_LENGTH.size
+        payload[field] = raw[offset:offset + length].decode('utf-8')
+        offset += length
+
+    msg = {
+        "type": event_type,
+        "datetime": time.strftime(DATETIME_FORMAT, time.gmtime(created))
+    }
+    if received_at_ms:
+        msg["received_at_ms"] = received_at_ms
+    msg["payload"] = payload
+    return msg
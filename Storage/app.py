@@ -1,17 +1,30 @@
 import connexion
 from connexion import NoContent
-from sqlalchemy import create_engine
+from flask import Response
+from sqlalchemy import func
 from sqlalchemy.orm import sessionmaker
 import datetime
 import yaml
 import logging.config
 from pykafka import KafkaClient
 from pykafka.common import OffsetType
-from threading import Thread
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+import envelope
 import json
+import heapq
+import itertools
 from personal_info import PersonalInfo
 from food_log import FoodLog
+from daily_nutrition import DailyNutrition
 from base import Base
+import writer
+import readings_query
+import archive
+from window_cache import WindowCache
+from read_pool import ReadPool, engine_url, read_engine
+import sharding
+import dead_letter
 import time
 import os
 
@@ -44,10 +57,25 @@ logger.info("Log Conf File: %s" % log_conf_file)
 # Logs Hostname
 logger.info(f"Connected to MySQL database at {db_hostname}:{db_port}")
 
-DB_ENGINE = create_engine(f'mysql+pymysql://{db_user}:{db_password}@{db_hostname}:{db_port}/{db_name}')
+# Users are spread over the shards by user_id; without shards the datastore is the only one
+SHARDS, shard_configs = sharding.write_router(app_config)
+DB_ENGINE = SHARDS.shards[0].engine
 Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
+# Read endpoints get their own pools so analytical reads do not hold up ingestion commits
+read_pool_config = app_config['datastore']['read_pool']
+for shard, shard_config in zip(SHARDS.shards, shard_configs):
+    shard.read_pool = ReadPool(
+        read_engine(engine_url(shard_config), read_pool_config),
+        [read_engine(engine_url(shard_config, replica), read_pool_config)
+         for replica in shard_config.get('replicas') or []],
+        selection=read_pool_config['selection'],
+        unhealthy_sec=read_pool_config['unhealthy_sec'])
+
+# Reads that span every shard query them in parallel
+SCATTER_EXECUTOR = ThreadPoolExecutor(max_workers=app_config['datastore']['scatter_threads'])
+
 
 max_retries = app_config["kafka"]["max_retries"]
 current_retry = 0
@@ -66,110 +94,564 @@ while current_retry < max_retries:
 else:
     logger.error("Max Retries reached. Could not connect to Kafka")
 
-def process_messages():
-    """ Process event messages """
-    logger.info("Starting Processing")
+def store_event(raw):
+    """ Decodes and writes one event, raising on failure """
+    rows = [writer.message_to_row(envelope.decode(raw))]
+    writer.write_sharded_rows(SHARDS, rows)
+    invalidate_cached_windows(rows)
+
+# Events that could not be stored are retried or parked here instead of holding up their partition
+dlq_producer = None
+if app_config['dlq']['sink'] == 'topic':
+    dlq_producer = client.topics[str.encode(app_config['dlq']['topic'])].get_sync_producer()
+DEAD_LETTERS = dead_letter.DeadLetters(app_config['dlq'], store_event, dlq_producer)
+
+def dead_letter_message(msg, error):
+    """ Hands a message that could not be stored to DEAD_LETTERS; False when that failed too """
+    try:
+        DEAD_LETTERS.failed(msg.value, error, msg.partition_id, msg.offset)
+        return True
+    except Exception as e:
+        logger.error(f"Could not dead-letter the message at partition {msg.partition_id} offset {msg.offset}: {e}")
+        return False
+
+def rewind(consumer, unhandled):
+    """ Moves the consumer back to the first message of each partition that was neither stored nor dead-lettered """
+    first_offsets = {}
+    for msg in unhandled:
+        first_offsets[msg.partition_id] = min(msg.offset, first_offsets.get(msg.partition_id, msg.offset))
+    # The consumer resumes after the offset it is reset to (-1 would mean the latest one)
+    consumer.reset_offsets([(topic.partitions[partition_id], offset - 1 if offset > 0 else OffsetType.EARLIEST)
+                            for partition_id, offset in first_offsets.items()])
+    logger.error(f"Consuming again from offsets {first_offsets} in {app_config['kafka']['sleep_time']}s")
+    time.sleep(app_config['kafka']['sleep_time'])
+
+def store_message(msg):
+    """ Stores a single event message in the database, returning it when it could not be dead-lettered either """
+    try:
+        store_event(msg.value)
+        logger.info("Data committed to the database.")
+    except Exception as e:
+        logger.error(f"Error processing message at offset {msg.offset}: {e}")
+        if not dead_letter_message(msg, e):
+            return [msg]
+    return []
+
+CONSUMER_STATS = {
+    "rows_total": 0,
+    "batches_total": 0,
+    "last_batch_rows_per_sec": 0.0,
+    "started": time.time()
+}
+CONSUMER_STATS_LOCK = Lock()
+
+def store_batch(messages):
+    """
+    Stores a batch of event messages with one bulk insert per table in a single transaction,
+    returning the messages that could neither be stored nor dead-lettered
+    """
+    start = time.time()
+    decoded = []
+    unhandled = []
+    for msg in messages:
+        try:
+            decoded.append((msg, writer.message_to_row(envelope.decode(msg.value))))
+        except Exception as e:
+            logger.error(f"Error processing message at offset {msg.offset}: {e}")
+            if not dead_letter_message(msg, e):
+                unhandled.append(msg)
+    if not decoded:
+        return unhandled
+
+    rows = [row for _, row in decoded]
+    stored = len(rows)
+    try:
+        writer.write_sharded_rows(SHARDS, rows)
+    except Exception as e:
+        if dead_letter.is_transient(e):
+            # The database is unreachable: spool the batch for the retry thread instead of stalling the partition
+            logger.error(f"Database unavailable, spooling batch of {len(rows)} events for retry: {e}")
+            unhandled += [msg for msg, _ in decoded if not dead_letter_message(msg, e)]
+            stored = 0
+        else:
+            logger.error(f"Batch insert failed, inserting rows one at a time: {e}")
+            stored = store_rows_individually(decoded, unhandled)
+    invalidate_cached_windows(rows)
+
+    elapsed = max(time.time() - start, 1e-6)
+    with CONSUMER_STATS_LOCK:
+        CONSUMER_STATS["rows_total"] += stored
+        CONSUMER_STATS["batches_total"] += 1
+        CONSUMER_STATS["last_batch_rows_per_sec"] = stored / elapsed
+    logger.info(f"Committed batch of {stored} rows in {elapsed:.3f}s ({stored / elapsed:.0f} rows/s)")
+    return unhandled
+
+def store_rows_individually(decoded, unhandled):
+    """
+    Inserts (message, row) pairs one transaction at a time so a single bad row only loses itself;
+    messages that cannot be dead-lettered either are added to unhandled
+    """
+    stored = 0
+    for msg, (table, row) in decoded:
+        try:
+            writer.write_sharded_rows(SHARDS, [(table, row)])
+            stored += 1
+        except Exception as e:
+            logger.error(f"Error storing {table.name} row with trace ID {row['trace_id']}: {e}")
+            if not dead_letter_message(msg, e):
+                unhandled.append(msg)
+    return stored
+
+def consume_batches(consumer):
+    """ Collects up to batch_size messages or linger_ms, stores them, then commits their offsets """
+    batch_size = app_config['consumer']['batch_size']
+    linger_sec = app_config['consumer']['linger_ms'] / 1000
+    batch = []
+    deadline = None
+
+    while True:
+        msg = consumer.consume()
+        if msg is not None:
+            batch.append(msg)
+            if deadline is None:
+                deadline = time.time() + linger_sec
+
+        if batch and (len(batch) >= batch_size or time.time() >= deadline):
+            unhandled = store_batch(batch)
+            if unhandled:
+                rewind(consumer, unhandled)
+            # Offsets only move once the rows are committed to the database (or dead-lettered)
+            consumer.commit_offsets()
+            batch = []
+            deadline = None
+
+def process_messages(partition=None):
+    """ Process event messages, from every partition or from a single one """
+    if partition is None:
+        logger.info("Starting Processing")
+    else:
+        logger.info(f"Starting Processing for partition {partition.id}")
+    # Events are keyed by user_id, so one consumer per partition keeps each user's events in order
+    batching = app_config['consumer']['batch_size'] > 1
     consumer = topic.get_simple_consumer(consumer_group=b'event_group',
+                                         partitions=None if partition is None else [partition],
                                          reset_offset_on_start=False,
-                                         auto_offset_reset=OffsetType.LATEST)
+                                         auto_offset_reset=OffsetType.LATEST,
+                                         consumer_timeout_ms=app_config['consumer']['linger_ms'] if batching else -1)
+
+    if batching:
+        consume_batches(consumer)
+        return
 
     for msg in consumer:
         if msg is not None:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            logger.info(f"Message: {msg}")
-            payload = msg["payload"]
-
-            session = DB_SESSION()
-
-            try:
-                if msg["type"] == "food_log":
-                    fl = FoodLog(
-                        payload["trace_id"],
-                        payload["user_id"],
-                        payload["timestamp"],
-                        payload["food_name"],
-                        payload["quantity"],
-                        payload["calories"],
-                        payload["carbohydrates"],
-                        payload["fats"],
-                        payload["proteins"]
-                    )
-                    session.add(fl)
-
-                elif msg["type"] == "personal_info":
-                    pi = PersonalInfo(
-                        payload["trace_id"],
-                        payload["activity_level"],
-                        payload["age"],
-                        payload["height"],
-                        payload["nutritional_goal"],
-                        payload["sex"],
-                        payload["user_id"],
-                        payload["weight"]
-                    )
-                    session.add(pi)
-
-                session.commit()
-                logger.info("Data committed to the database.")
-            except Exception as e:
-                logger.error(f"Error processing message: {e}")
-                session.rollback()
-            finally:
-                session.close()
-
+            unhandled = store_message(msg)
+            if unhandled:
+                rewind(consumer, unhandled)
             consumer.commit_offsets()
 
+def start_consumers():
+    """ Starts the Kafka consumer threads for the configured consumer mode """
+    if app_config['consumer']['mode'] != 'partitioned':
+        t1 = Thread(target=process_messages)
+        t1.setDaemon(True)
+        t1.start()
+        return
 
+    partitions = sorted(topic.partitions.values(), key=lambda partition: partition.id)
+    if len(partitions) != app_config['consumer']['partitions']:
+        logger.warning(f"Topic has {len(partitions)} partitions, expected {app_config['consumer']['partitions']}")
+    for partition in partitions:
+        t = Thread(target=process_messages, args=(partition,))
+        t.setDaemon(True)
+        t.start()
 
-def get_personal_info(start_timestamp, end_timestamp):
-    """ Gets personal info readings between start and end timestamps """
-    session = DB_SESSION()
+
+
+WINDOW_CACHE = WindowCache(app_config['cache']['max_bytes'])
+
+def invalidate_cached_windows(rows):
+    """ Drops cached windows that written (table, row) pairs fall into """
+    created_by_table = {}
+    for table, row in rows:
+        created_by_table.setdefault(table.name, []).append(row["date_created"])
+    for table_name, created in created_by_table.items():
+        WINDOW_CACHE.invalidate(table_name, min(created), max(created))
+
+def json_response(body, headers):
+    """ Serves an already serialized JSON body as is """
+    response = Response(iter((body,)), mimetype="application/json", headers=headers)
+    response.headers["Content-Length"] = str(len(body))
+    # Stops connexion from parsing the body again to validate it (see ProjectedReading for fields=)
+    response.direct_passthrough = True
+    return response
+
+def parse_window(start_timestamp, end_timestamp):
+    """ Parses the start and end of a query window, raising ValueError with a message for the client """
     try:
         start_timestamp_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%SZ")
         end_timestamp_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%SZ")
     except ValueError as e:
         logger.error(f"Error parsing timestamp: {e}")
-        return {"message": "Invalid timestamp format"}, 400
+        raise ValueError("Invalid timestamp format")
 
     if start_timestamp_datetime >= end_timestamp_datetime:
-        return {"message": "Start timestamp must be earlier than end timestamp"}, 400
+        raise ValueError("Start timestamp must be earlier than end timestamp")
+    return start_timestamp_datetime, end_timestamp_datetime
 
-    readings = session.query(PersonalInfo).filter(PersonalInfo.date_created >= start_timestamp_datetime, PersonalInfo.date_created < end_timestamp_datetime)
-    results_list = [reading.to_dict() for reading in readings]
-    session.close()
-    return results_list, 200
+def scatter(function, *args):
+    """ Calls function(shard, *args) for every shard, in parallel when there are several """
+    if len(SHARDS.shards) == 1:
+        return [function(SHARDS.shards[0], *args)]
+    return list(SCATTER_EXECUTOR.map(lambda shard: function(shard, *args), SHARDS.shards))
 
-def get_food_log(start_timestamp, end_timestamp):
-    """ Gets food log readings between start and end timestamps """
-    session = DB_SESSION()
+def read_archived(shard, model, columns, start, end, limit, after_id):
+    """ Food log rows of the window that were moved to the shard's archive, if it is enabled """
+    if model is not FoodLog or not app_config['archive']['enabled']:
+        return []
+    return archive.read_readings(shard.archive_path, model.__table__, columns, start, end, limit, after_id)
+
+def read_shard(shard, model, columns, start, end, limit, after_id, user_ids=None):
+    """ One shard's readings in a window, hot and archived, with ids made unique across shards """
+    if user_ids is not None:
+        # A user's readings are all on the shard they are routed to
+        user_ids = [user_id for user_id in user_ids if SHARDS.for_user(user_id) is shard]
+        if not user_ids:
+            return []
+    local_after_id = SHARDS.local_after_id(shard, after_id)
+    statement = readings_query.select_readings(model, columns, start, end, limit, local_after_id, user_ids=user_ids)
+    results_list = []
+    with shard.read_pool.connect() as connection:
+        for readings in readings_query.fetch_readings(connection, columns, statement,
+                                                      app_config['stream']['chunk_rows']):
+            results_list.extend(readings)
+    results_list = archive.merge_readings(
+        read_archived(shard, model, columns, start, end, limit, local_after_id), results_list, limit)
+
+    if SHARDS.sharded:
+        for reading in results_list:
+            reading["id"] = SHARDS.global_id(shard, reading["id"])
+    return results_list
+
+def created_order(reading):
+    """ Sort key for date_created strings, with or without microseconds """
+    created = reading["date_created"][:-1]
+    return created if "." in created else created + ".000000"
+
+def merge_shards(results, columns, limit, after_id):
+    """ Merges the readings of every shard: by id when paginating, otherwise by date_created """
+    if len(results) == 1:
+        return results[0]
+    merged = [reading for readings in results for reading in readings]
+    if limit is not None or after_id is not None:
+        merged.sort(key=lambda reading: reading["id"])
+    elif any(column.name == "date_created" for column in columns):
+        merged.sort(key=created_order)
+    return merged[:limit] if limit is not None else merged
+
+def get_readings(model, start_timestamp, end_timestamp, limit, after_id, fields, user_ids=None):
+    """ Gets readings between start and end timestamps, optionally one keyset page at a time or of some users """
     try:
-        start_timestamp_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%SZ")
-        end_timestamp_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%SZ")
+        start, end = parse_window(start_timestamp, end_timestamp)
+        columns = readings_query.reading_columns(model, fields)
     except ValueError as e:
-        logger.error(f"Error parsing timestamp: {e}")
-        return {"message": "Invalid timestamp format"}, 400
+        return {"message": str(e)}, 400
 
-    if start_timestamp_datetime >= end_timestamp_datetime:
-        return {"message": "Start timestamp must be earlier than end timestamp"}, 400
+    # Only windows that closed a while ago are cached, later writes land after them
+    closed = end <= datetime.datetime.now() - datetime.timedelta(seconds=app_config['cache']['closed_after_sec'])
+    if closed:
+        cache_key = (model.__tablename__, start, end, limit, after_id, tuple(fields or ()),
+                     None if user_ids is None else tuple(user_ids))
+        cached = WINDOW_CACHE.get(cache_key)
+        if cached is not None:
+            return json_response(*cached)
+        generation = WINDOW_CACHE.generation
+
+    results_list = merge_shards(scatter(read_shard, model, columns, start, end, limit, after_id, user_ids),
+                                columns, limit, after_id)
+
+    headers = {}
+    if limit is not None and len(results_list) == limit:
+        # Pass this back as after_id to get the next page
+        headers["X-Next-After-Id"] = str(results_list[-1]["id"])
 
-    readings = session.query(FoodLog).filter(FoodLog.date_created >= start_timestamp_datetime, FoodLog.date_created < end_timestamp_datetime)
-    results_list = [reading.to_dict() for reading in readings]
-    session.close()
+    body = json.dumps(results_list).encode('utf-8')
+    if closed:
+        WINDOW_CACHE.put(cache_key, body, headers, start, end, generation)
+    return json_response(body, headers)
+
+def stream_order(columns, limit, after_id):
+    """ Column the streamed readings of every shard are merged on: id when paginating, else date_created if read """
+    if limit is None and after_id is None and any(column.name == "date_created" for column in columns):
+        return "date_created"
+    return "id"
+
+def order_key(order):
+    """ Sort key of readings for a stream_order column """
+    return created_order if order == "date_created" else lambda reading: reading["id"]
+
+def stream_shard(shard, model, columns, start, end, limit, after_id, order):
+    """ Yields one shard's readings in a window in order (see stream_order), archived ones merged in """
+    local_after_id = SHARDS.local_after_id(shard, after_id)
+    key = order_key(order)
+    archived = sorted(read_archived(shard, model, columns, start, end, limit, local_after_id), key=key)
+    archived_ids = {reading["id"] for reading in archived}
+
+    def hot():
+        statement = readings_query.select_readings(model, columns, start, end, limit, local_after_id,
+                                                   order_by=order)
+        with shard.read_pool.connect() as connection:
+            for readings in readings_query.fetch_readings(connection, columns, statement,
+                                                          app_config['stream']['chunk_rows']):
+                for reading in readings:
+                    if reading["id"] not in archived_ids:
+                        yield reading
+
+    for reading in heapq.merge(archived, hot(), key=key):
+        if SHARDS.sharded:
+            # Global ids keep the order of the shard's own ones
+            reading["id"] = SHARDS.global_id(shard, reading["id"])
+        yield reading
+
+def stream_readings(model, start_timestamp, end_timestamp, limit, after_id, fields):
+    """ Streams readings as NDJSON from server-side cursors so memory does not grow with the window """
+    try:
+        start, end = parse_window(start_timestamp, end_timestamp)
+        columns = readings_query.reading_columns(model, fields)
+    except ValueError as e:
+        return {"message": str(e)}, 400
+
+    order = stream_order(columns, limit, after_id)
+    key = order_key(order)
+
+    def generate():
+        # Every shard's cursor is read at once and merged, like merge_shards does for the other reads
+        readings = heapq.merge(*[stream_shard(shard, model, columns, start, end, limit, after_id, order)
+                                 for shard in SHARDS.shards], key=key)
+        readings = itertools.islice(readings, limit)
+        chunk_rows = app_config['stream']['chunk_rows']
+        while True:
+            chunk = list(itertools.islice(readings, chunk_rows))
+            if not chunk:
+                return
+            yield "".join(json.dumps(reading) + "\n" for reading in chunk)
+
+    response = Response(generate(), mimetype="application/x-ndjson")
+    # Stops connexion from buffering the whole body to validate it
+    response.direct_passthrough = True
+    return response
+
+STATS_FIELDS = {
+    PersonalInfo: ("age", "height", "weight"),
+    FoodLog: ("quantity", "calories", "carbohydrates", "fats", "proteins"),
+}
+
+def group_key(session, model, group_by):
+    """ SQL expression for the group_by option of the stats endpoints """
+    if group_by == "user_id":
+        return model.user_id
+    if session.bind.dialect.name == "sqlite":
+        return func.strftime("%Y-%m-%dT%H:00:00Z", model.date_created)
+    return func.date_format(model.date_created, "%Y-%m-%dT%H:00:00Z")
+
+def number(value):
+    """ Converts an aggregate from the database (possibly a Decimal) to an int or float """
+    if value is None:
+        return None
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+def aggregate_row(fields, row):
+    """ Dictionary form of a (count, max, min, sum, avg for each field) result row """
+    result = {"count": row[0], "fields": {}}
+    for i, field in enumerate(fields):
+        max_value, min_value, sum_value, avg_value = row[1 + 4 * i:5 + 4 * i]
+        result["fields"][field] = {
+            "max": number(max_value),
+            "min": number(min_value),
+            "sum": number(sum_value) if sum_value is not None else 0,
+            "avg": float(avg_value) if avg_value is not None else None
+        }
+    return result
+
+def combine_aggregates(results):
+    """ Combines the aggregates of several shards into those of all their rows """
+    if len(results) == 1:
+        return results[0]
+    count = sum(result["count"] for result in results)
+    combined = {"count": count, "fields": {}}
+    for field in results[0]["fields"]:
+        values = [result["fields"][field] for result in results]
+        total = sum(value["sum"] for value in values)
+        combined["fields"][field] = {
+            "max": max((value["max"] for value in values if value["max"] is not None), default=None),
+            "min": min((value["min"] for value in values if value["min"] is not None), default=None),
+            "sum": total,
+            "avg": total / count if count else None
+        }
+    return combined
+
+def shard_reading_stats(shard, model, start, end, group_by):
+    """ Aggregates of one shard's readings in a window """
+    fields = STATS_FIELDS[model]
+    aggregates = [func.count(model.id)]
+    for field in fields:
+        column = getattr(model, field)
+        aggregates += [func.max(column), func.min(column), func.sum(column), func.avg(column)]
+
+    with shard.read_pool.connect() as connection:
+        session = DB_SESSION(bind=connection)
+        try:
+            window = (model.date_created >= start, model.date_created < end)
+            result = aggregate_row(fields, session.query(*aggregates).filter(*window).one())
+            if group_by is not None:
+                key = group_key(session, model, group_by)
+                rows = session.query(key, *aggregates).filter(*window).group_by(key).order_by(key)
+                result["groups"] = [dict(aggregate_row(fields, row[1:]), key=str(row[0])) for row in rows]
+        finally:
+            session.close()
+    return result
+
+def get_reading_stats(model, start_timestamp, end_timestamp, group_by):
+    """ Gets count, max, min, sum and avg of the numeric fields in a window, computed by the database """
+    try:
+        start, end = parse_window(start_timestamp, end_timestamp)
+    except ValueError as e:
+        return {"message": str(e)}, 400
+
+    results = scatter(shard_reading_stats, model, start, end, group_by)
+    result = combine_aggregates(results)
+    if group_by is not None and len(results) > 1:
+        groups = {}
+        for shard_result in results:
+            for group in shard_result["groups"]:
+                groups.setdefault(group["key"], []).append(group)
+        order = (lambda key: int(key)) if group_by == "user_id" else (lambda key: key)
+        result["groups"] = [dict(combine_aggregates(groups[key]), key=key) for key in sorted(groups, key=order)]
+    return result, 200
+
+def get_personal_info_stats(start_timestamp, end_timestamp, group_by=None):
+    """ Gets personal info aggregates between start and end timestamps """
+    return get_reading_stats(PersonalInfo, start_timestamp, end_timestamp, group_by)
+
+def get_food_log_stats(start_timestamp, end_timestamp, group_by=None):
+    """ Gets food log aggregates between start and end timestamps """
+    return get_reading_stats(FoodLog, start_timestamp, end_timestamp, group_by)
+
+def get_daily_nutrition(user_id, from_, to):
+    """ Gets a user's food log totals per day, from and to inclusive """
+    try:
+        first_day = datetime.datetime.strptime(from_, "%Y-%m-%d").date()
+        last_day = datetime.datetime.strptime(to, "%Y-%m-%d").date()
+    except ValueError:
+        return {"message": "Invalid date format"}, 400
+    if first_day > last_day:
+        return {"message": "from must not be later than to"}, 400
+
+    # A user's rows, and so their totals, are all on one shard
+    with SHARDS.for_user(user_id).read_pool.connect() as connection:
+        session = DB_SESSION(bind=connection)
+        try:
+            days = session.query(DailyNutrition).filter(
+                DailyNutrition.user_id == user_id,
+                DailyNutrition.day >= first_day,
+                DailyNutrition.day <= last_day
+            ).order_by(DailyNutrition.day)
+            results_list = [day.to_dict() for day in days]
+        finally:
+            session.close()
+
+    logger.info(f"Query for daily nutrition of user {user_id} from {from_} to {to} returns {len(results_list)} days")
     return results_list, 200
 
+def get_personal_info(start_timestamp, end_timestamp, limit=None, after_id=None, fields=None, user_ids=None):
+    """ Gets personal info readings between start and end timestamps """
+    return get_readings(PersonalInfo, start_timestamp, end_timestamp, limit, after_id, fields, user_ids)
+
+def get_food_log(start_timestamp, end_timestamp, limit=None, after_id=None, fields=None):
+    """ Gets food log readings between start and end timestamps """
+    return get_readings(FoodLog, start_timestamp, end_timestamp, limit, after_id, fields)
+
+def stream_personal_info(start_timestamp, end_timestamp, limit=None, after_id=None, fields=None):
+    """ Streams personal info readings between start and end timestamps as NDJSON """
+    return stream_readings(PersonalInfo, start_timestamp, end_timestamp, limit, after_id, fields)
+
+def stream_food_log(start_timestamp, end_timestamp, limit=None, after_id=None, fields=None):
+    """ Streams food log readings between start and end timestamps as NDJSON """
+    return stream_readings(FoodLog, start_timestamp, end_timestamp, limit, after_id, fields)
+
+
+def shard_trace(shard, trace_id):
+    """ The (event type, reading) with a trace_id on one shard, None when it has none """
+    with shard.read_pool.connect() as connection:
+        for event_type, model in (("personal_info", PersonalInfo), ("food_log", FoodLog)):
+            columns = list(model.__table__.columns)
+            for readings in readings_query.fetch_readings(connection, columns,
+                                                          readings_query.select_trace(model, trace_id), 1):
+                if readings:
+                    if SHARDS.sharded:
+                        readings[0]["id"] = SHARDS.global_id(shard, readings[0]["id"])
+                    return event_type, readings[0]
+    return None
+
+def get_trace(trace_id):
+    """ Gets the reading stored for a trace ID and when it was stored, for end-to-end latency tracing """
+    found = [result for result in scatter(shard_trace, trace_id) if result is not None]
+    if not found:
+        # Archived readings are only read by window, so they are not found here either
+        return {"message": f"No reading with trace ID {trace_id}"}, 404
+
+    event_type, reading = found[0]
+    # date_created is the local time the consumer built the row, just before committing its batch
+    stored_at = datetime.datetime.strptime(created_order(reading), "%Y-%m-%dT%H:%M:%S.%f")
+    return {
+        "type": event_type,
+        "reading": reading,
+        "stored_at_ms": int(stored_at.timestamp() * 1000)
+    }, 200
+
+def get_consumer_stats():
+    """ Gets ingestion counters for the batching consumer """
+    with CONSUMER_STATS_LOCK:
+        uptime = max(time.time() - CONSUMER_STATS["started"], 1e-6)
+        return {
+            "rows_total": CONSUMER_STATS["rows_total"],
+            "batches_total": CONSUMER_STATS["batches_total"],
+            "last_batch_rows_per_sec": round(CONSUMER_STATS["last_batch_rows_per_sec"], 1),
+            "avg_rows_per_sec": round(CONSUMER_STATS["rows_total"] / uptime, 1),
+            **DEAD_LETTERS.stats()
+        }, 200
+
+
+def get_cache_stats():
+    """ Gets hit, miss, eviction and invalidation counters of the window cache """
+    return WINDOW_CACHE.stats(), 200
+
+
+def invalidate_cache(start_timestamp=None, end_timestamp=None):
+    """ Drops cached windows overlapping a range (all of them without one), e.g. after a backfill """
+    try:
+        start = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%SZ") if start_timestamp else None
+        end = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%SZ") if end_timestamp else None
+    except ValueError:
+        return {"message": "Invalid timestamp format"}, 400
+
+    WINDOW_CACHE.invalidate(None, start, end)
+    logger.info(f"Invalidated cached windows between {start_timestamp} and {end_timestamp}")
+    return NoContent, 204
+
 
 def healthCheck():
     return NoContent, 200
 
 
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api('calorie-tracker.yml', base_path="/storage", strict_validation=True, validate_responses=True)
+app.add_api('calorie-tracker.yml', base_path="/storage", strict_validation=True, validate_responses=True,
+            pythonic_params=True)
 
 if __name__ == "__main__":
     
-    t1 = Thread(target=process_messages)
-    t1.setDaemon(True)
-    t1.start()
+    start_consumers()
+    DEAD_LETTERS.start()
     
     app.run(port=8090)
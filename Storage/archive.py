@@ -0,0 +1,184 @@
+"""
+Cold tier for old food log rows.
+
+    python3 archive.py                      # archive rows older than archive.older_than_days
+    python3 archive.py --older-than-days 30
+
+Rows whose date_created is older than the cutoff are copied to zstd-compressed
+Parquet files, one directory per day:
+
+    <archive.path>/food_log/date=2023-11-23/part-<first id>-<last id>.parquet
+
+and then deleted from MySQL, so the hot table only holds recent rows. Range
+reads open only the day directories their window overlaps and merge those rows
+with the hot ones. A run that stops between writing a file and deleting its
+rows is finished by the next run, which skips IDs already in the day's files.
+"""
+import argparse
+import datetime
+import os
+import time
+import pyarrow as pa
+import pyarrow.parquet as pq
+import yaml
+from sqlalchemy import select, Integer, String, DateTime
+from food_log import FoodLog
+import readings_query
+import sharding
+
+DAY_PREFIX = "date="
+
+
+def archive_cutoff(older_than_days):
+    """ Start of the oldest day kept in MySQL; rows created before it belong in the archive """
+    return datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=older_than_days),
+                                     datetime.time())
+
+
+def archived_until(root, table_name="food_log"):
+    """ End of the newest day with archived rows (every older row of the table is archived), None without one """
+    table_directory = os.path.join(root, table_name)
+    if not os.path.isdir(table_directory):
+        return None
+    days = [name[len(DAY_PREFIX):] for name in os.listdir(table_directory) if name.startswith(DAY_PREFIX)]
+    if not days:
+        return None
+    newest = datetime.datetime.strptime(max(days), "%Y-%m-%d")
+    return newest + datetime.timedelta(days=1)
+
+
+def arrow_type(column):
+    """ Parquet column type for a table column """
+    column_type = getattr(column.type, "impl", column.type)
+    if isinstance(column_type, Integer):
+        return pa.int64()
+    if isinstance(column_type, DateTime):
+        return pa.timestamp("us")
+    if isinstance(column_type, String):
+        return pa.string()
+    raise ValueError(f"No archive type for column {column.name}")
+
+
+def day_files(root, table_name, start, end):
+    """ Parquet files of the days overlapping the window [start, end) """
+    table_directory = os.path.join(root, table_name)
+    if not os.path.isdir(table_directory):
+        return []
+    first_day = start.date().isoformat()
+    last_day = (end - datetime.timedelta(microseconds=1)).date().isoformat()
+
+    files = []
+    for day_directory in sorted(os.listdir(table_directory)):
+        day = day_directory[len(DAY_PREFIX):]
+        if not day_directory.startswith(DAY_PREFIX) or not first_day <= day <= last_day:
+            continue
+        directory = os.path.join(table_directory, day_directory)
+        files += [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                  if name.endswith(".parquet")]
+    return files
+
+
+def read_readings(root, table, columns, start, end, limit, after_id):
+    """ Archived readings in a window as reading dictionaries, in id order and at most limit of them """
+    files = day_files(root, table.name, start, end)
+    if not files:
+        return []
+
+    filters = [("date_created", ">=", start), ("date_created", "<", end)]
+    if after_id is not None:
+        filters.append(("id", ">", after_id))
+    names = [column.name for column in columns]
+    data = pq.read_table(files, columns=names, filters=filters).to_pydict()
+
+    rows = sorted(zip(*[data[name] for name in names]), key=lambda row: row[0])
+    if limit is not None:
+        rows = rows[:limit]
+    return readings_query.to_readings(names, readings_query.datetime_column_names(columns), rows)
+
+
+def merge_readings(cold, hot, limit):
+    """ Combines archived and hot readings, dropping hot copies of rows still being archived """
+    if not cold:
+        return hot
+    cold_ids = {reading["id"] for reading in cold}
+    merged = cold + [reading for reading in hot if reading["id"] not in cold_ids]
+    if limit is not None:
+        merged = sorted(merged, key=lambda reading: reading["id"])[:limit]
+    return merged
+
+
+def archived_ids(directory):
+    """ IDs already written to a day's files """
+    files = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".parquet")]
+    if not files:
+        return set()
+    return set(pq.read_table(files, columns=["id"]).column("id").to_pylist())
+
+
+def write_day(root, table, day, rows):
+    """ Writes one day's rows to a new Parquet file, skipping rows an earlier run already wrote """
+    directory = os.path.join(root, table.name, f"{DAY_PREFIX}{day.isoformat()}")
+    os.makedirs(directory, exist_ok=True)
+    done = archived_ids(directory)
+    rows = [row for row in rows if row[0] not in done]
+    if not rows:
+        return 0
+
+    schema = pa.schema([(column.name, arrow_type(column)) for column in table.columns])
+    batch = pa.Table.from_arrays([pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)],
+                                 schema=schema)
+    name = f"part-{rows[0][0]}-{rows[-1][0]}.parquet"
+    # Written under a temporary name so readers never see a partial file
+    temporary = os.path.join(directory, f".{name}.tmp")
+    pq.write_table(batch, temporary, compression="zstd")
+    os.replace(temporary, os.path.join(directory, name))
+    return len(rows)
+
+
+def archive_table(engine, root, table, cutoff, batch_rows):
+    """ Moves the table's rows older than the cutoff to the archive, batch_rows at a time in id order """
+    archived = 0
+    while True:
+        with engine.connect() as connection:
+            rows = connection.execute(select(table).where(table.c.date_created < cutoff)
+                                      .order_by(table.c.id).limit(batch_rows)).fetchall()
+        if not rows:
+            return archived
+
+        rows_by_day = {}
+        for row in rows:
+            rows_by_day.setdefault(row.date_created.date(), []).append(tuple(row))
+        for day, day_rows in sorted(rows_by_day.items()):
+            write_day(root, table, day, day_rows)
+
+        # Every row in this id range older than the cutoff was in the batch
+        with engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.id >= rows[0].id, table.c.id <= rows[-1].id,
+                                                    table.c.date_created < cutoff))
+        archived += len(rows)
+        print(f"Archived {archived} {table.name} rows (up to id {rows[-1].id})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move old food log rows to the Parquet archive")
+    parser.add_argument("--older-than-days", type=int, help="default: archive.older_than_days")
+    parser.add_argument("--config", default="app_conf.yml", help="Storage app_conf.yml to read")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        app_config = yaml.safe_load(f.read())
+
+    router, _ = sharding.write_router(app_config)
+
+    older_than_days = args.older_than_days or app_config['archive']['older_than_days']
+    cutoff = archive_cutoff(older_than_days)
+    for shard in router.shards:
+        started = time.time()
+        archived = archive_table(shard.engine, shard.archive_path, FoodLog.__table__, cutoff,
+                                 app_config['archive']['batch_rows'])
+        print(f"Archived {archived} rows older than {cutoff} from shard {shard.number} "
+              f"in {time.time() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
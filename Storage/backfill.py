@@ -0,0 +1,172 @@
+"""
+Replays the events topic into MySQL, e.g. to rebuild a replica.
+
+    python3 backfill.py                                   # from the earliest offset
+    python3 backfill.py --from-timestamp 2023-11-23T00:00:00Z
+
+Each partition is read by its own thread without a consumer group, so the live
+Storage consumer's offsets are untouched. Rows are bulk inserted and duplicate
+trace IDs are skipped, so the replay can be re-run or overlap the live consumer.
+
+When the archive is enabled, food log events up to the newest day archived on
+their user's shard are skipped, since their rows already live in the archive
+files. Personal info is never archived, so all of it is replayed.
+
+Replayed rows keep their original date_created, so pass --storage-url (e.g.
+http://localhost:8090/storage) to drop the range reads Storage has cached for
+the replayed period.
+"""
+import argparse
+import datetime
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+import yaml
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
+import archive
+import envelope
+import sharding
+import writer
+
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def in_archive(router, archived_until, event, created):
+    """ Whether an event's row was moved to its shard's archive (only food logs are archived) """
+    if event["type"] != "food_log":
+        return False
+    bound = archived_until.get(router.for_user(event["payload"]["user_id"]).number)
+    return bound is not None and created < bound
+
+
+def replay_partition(topic, partition, router, from_datetime, archived_until, batch_size, progress):
+    """ Copies one partition, up to the last offset present when the replay started, into the database """
+    end_offset = partition.latest_available_offset() - 1
+    progress[partition.id] = {"rows": 0, "offset": -1, "end_offset": end_offset, "done": end_offset < 0,
+                              "error": None}
+    if end_offset < 0:
+        return
+
+    consumer = topic.get_simple_consumer(partitions=[partition],
+                                         auto_offset_reset=OffsetType.EARLIEST,
+                                         reset_offset_on_start=True,
+                                         consumer_timeout_ms=10000)
+    if from_datetime is not None:
+        # Kafka only resolves this to a log segment boundary; the envelope datetime filters the rest
+        consumer.reset_offsets([(partition, from_datetime)])
+
+    rows = []
+
+    def flush():
+        if rows:
+            writer.write_sharded_rows(router, rows)
+        progress[partition.id]["rows"] += len(rows)
+        rows.clear()
+
+    try:
+        while True:
+            msg = consumer.consume()
+            if msg is None:
+                progress[partition.id]["error"] = f"Timed out before reaching the end offset {end_offset}"
+                break
+
+            try:
+                event = envelope.decode(msg.value)
+                created = datetime.datetime.strptime(event["datetime"], DATETIME_FORMAT)
+                if (from_datetime is None or created >= from_datetime) and \
+                        not in_archive(router, archived_until, event, created):
+                    rows.append(writer.message_to_row(event, date_created=created))
+            except Exception as e:
+                print(f"Skipping partition {partition.id} offset {msg.offset}: {e}")
+
+            if len(rows) >= batch_size:
+                flush()
+            progress[partition.id]["offset"] = msg.offset
+
+            if msg.offset >= end_offset:
+                break
+        # What was read before the end (or a timeout) is written too
+        flush()
+    except Exception as e:
+        progress[partition.id]["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        consumer.stop()
+        progress[partition.id]["done"] = True
+
+
+def report(progress, started):
+    """ Prints rows copied and throughput so far """
+    elapsed = max(time.time() - started, 1e-6)
+    rows = sum(p["rows"] for p in progress.values())
+    partitions = ", ".join(f"p{pid} {p['offset'] + 1}/{p['end_offset'] + 1}"
+                           for pid, p in sorted(progress.items()))
+    print(f"{rows} rows in {elapsed:.1f}s ({rows / elapsed:.0f} rows/s) [{partitions}]")
+
+
+def invalidate_cache(storage_url, from_timestamp):
+    """ Asks a running Storage service to drop cached windows from the replayed period on """
+    query = urllib.parse.urlencode({"start_timestamp": from_timestamp} if from_timestamp else {})
+    request = urllib.request.Request(f"{storage_url}/cache?{query}", method="DELETE")
+    with urllib.request.urlopen(request, timeout=10) as response:
+        print(f"Invalidated Storage window cache ({response.status})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay the events topic into the Storage database")
+    parser.add_argument("--from-timestamp", help="only replay events received at or after this time, "
+                                                 "e.g. 2023-11-23T00:00:00Z (default: earliest offset)")
+    parser.add_argument("--batch-size", type=int, default=5000, help="rows per bulk insert")
+    parser.add_argument("--config", default="app_conf.yml", help="Storage app_conf.yml to read")
+    parser.add_argument("--storage-url", help="Storage base URL whose window cache to invalidate when done")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        app_config = yaml.safe_load(f.read())
+
+    from_datetime = None
+    if args.from_timestamp:
+        from_datetime = datetime.datetime.strptime(args.from_timestamp, DATETIME_FORMAT)
+    router, _ = sharding.write_router(app_config)
+
+    # Shard number -> end of the newest archived day, from what archive.py actually wrote
+    archived_until = {}
+    if app_config['archive']['enabled']:
+        for shard in router.shards:
+            archived_until[shard.number] = archive.archived_until(shard.archive_path)
+            if archived_until[shard.number] is not None:
+                print(f"Skipping shard {shard.number} food logs before {archived_until[shard.number]}, "
+                      f"they are in the archive")
+
+    client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
+    topic = client.topics[str.encode(app_config['events']['topic'])]
+
+    progress = {}
+    started = time.time()
+    threads = []
+    for partition in sorted(topic.partitions.values(), key=lambda partition: partition.id):
+        t = threading.Thread(target=replay_partition,
+                             args=(topic, partition, router, from_datetime, archived_until, args.batch_size,
+                                   progress))
+        t.start()
+        threads.append(t)
+
+    while any(t.is_alive() for t in threads):
+        report(progress, started)
+        time.sleep(2)
+    report(progress, started)
+
+    if args.storage_url:
+        invalidate_cache(args.storage_url, args.from_timestamp)
+
+    failed = {pid: p["error"] for pid, p in sorted(progress.items()) if p["error"]}
+    for pid, error in failed.items():
+        print(f"Partition {pid} was not fully replayed: {error}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
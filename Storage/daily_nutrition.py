@@ -0,0 +1,32 @@
+from sqlalchemy import Column, Integer, Date, DateTime
+from sqlalchemy.dialects import mysql
+from base import Base
+
+class DailyNutrition(Base):
+    """ Per user and day totals of the food log, kept up to date by the Storage consumer """
+
+    __tablename__ = "daily_nutrition"
+
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    day = Column(Date, primary_key=True)
+    entries = Column(Integer, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    calories = Column(Integer, nullable=False)
+    carbohydrates = Column(Integer, nullable=False)
+    fats = Column(Integer, nullable=False)
+    proteins = Column(Integer, nullable=False)
+    date_updated = Column(DateTime().with_variant(mysql.DATETIME(fsp=6), "mysql"), nullable=False)
+
+    def to_dict(self):
+        """ Dictionary Representation of a daily nutrition total """
+        dict = {}
+        dict['user_id'] = self.user_id
+        dict['day'] = self.day.isoformat()
+        dict['entries'] = self.entries
+        dict['quantity'] = self.quantity
+        dict['calories'] = self.calories
+        dict['carbohydrates'] = self.carbohydrates
+        dict['fats'] = self.fats
+        dict['proteins'] = self.proteins
+
+        return dict
@@ -0,0 +1,164 @@
+"""
+Side lane for events the Storage consumer could not write.
+
+The consumer hands failed events over and commits their offsets, so a bad or
+temporarily unwritable event never holds up its partition:
+
+- an event that failed on a database error (OperationalError/InterfaceError)
+  is spooled to <path>/retry/ and retried by a background thread with
+  exponential backoff, up to max_attempts
+- an event that cannot be decoded or stored as is, or ran out of attempts, is
+  dead-lettered: written to <path>/dead/ (sink: spool) or produced to the
+  dead letter topic (sink: topic), where redrive.py can replay it from
+
+Each spooled event is its own JSON file, written under a temporary name and
+renamed, so a crash never leaves a partial record and the retry thread picks
+up where it left off after a restart.
+"""
+import base64
+import json
+import logging
+import os
+import time
+import uuid
+from threading import Thread, Lock
+
+from sqlalchemy.exc import OperationalError, InterfaceError
+
+logger = logging.getLogger('basicLogger')
+
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+
+def is_transient(error):
+    """ Whether an error is worth retrying later, as opposed to one the event itself causes """
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def make_record(raw, error, partition=None, offset=None):
+    """ Spool/topic record for an event and the error it failed with """
+    now = time.time()
+    return {
+        "id": str(uuid.uuid4()),
+        "value": base64.b64encode(raw).decode('ascii'),
+        "partition": partition,
+        "offset": offset,
+        "error": f"{type(error).__name__}: {error}",
+        "attempts": 1,
+        "first_failed_at": now,
+        "next_attempt_at": now
+    }
+
+
+def record_value(record):
+    """ The original message bytes of a record """
+    return base64.b64decode(record["value"])
+
+
+def write_record(directory, record):
+    """ Atomically writes a record to <directory>/<id>.json """
+    path = os.path.join(directory, f"{record['id']}.json")
+    temporary = os.path.join(directory, f".{record['id']}.tmp")
+    with open(temporary, 'w') as f:
+        json.dump(record, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def read_records(directory):
+    """ Every record in a spool directory """
+    records = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".json"):
+            with open(os.path.join(directory, name)) as f:
+                records.append(json.load(f))
+    return records
+
+
+class DeadLetters:
+    """ Retry spool and dead letter sink, with the background retry thread """
+
+    def __init__(self, config, store, producer=None):
+        """ store(raw) writes one event and raises on failure; producer is needed for sink: topic """
+        self.config = config
+        self.store = store
+        self.producer = producer
+        self.retry_directory = os.path.join(config['path'], "retry")
+        self.dead_directory = os.path.join(config['path'], "dead")
+        os.makedirs(self.retry_directory, exist_ok=True)
+        os.makedirs(self.dead_directory, exist_ok=True)
+        self.counters = {"retry_pending": len(read_records(self.retry_directory)),
+                         "retried": 0, "dead_lettered": 0}
+        self.lock = Lock()
+
+    def failed(self, raw, error, partition=None, offset=None):
+        """ Takes over an event the consumer could not store """
+        record = make_record(raw, error, partition, offset)
+        if is_transient(error):
+            record["next_attempt_at"] = time.time() + self.backoff(1)
+            write_record(self.retry_directory, record)
+            with self.lock:
+                self.counters["retry_pending"] += 1
+            logger.warning(f"Spooled event at offset {offset} for retry: {record['error']}")
+        else:
+            self.dead_letter(record)
+
+    def dead_letter(self, record):
+        """ Parks a record in the sink for redrive.py """
+        if self.config['sink'] == 'topic':
+            self.producer.produce(json.dumps(record).encode('utf-8'))
+        else:
+            write_record(self.dead_directory, record)
+        with self.lock:
+            self.counters["dead_lettered"] += 1
+        logger.error(f"Dead-lettered event at offset {record['offset']}: {record['error']}")
+
+    def backoff(self, attempts):
+        """ Seconds to wait after a number of failed attempts """
+        return min(self.config['retry_base_sec'] * 2 ** (attempts - 1), self.config['retry_max_sec'])
+
+    def retry_due(self):
+        """ Retries every spooled event whose backoff has passed """
+        now = time.time()
+        for record in read_records(self.retry_directory):
+            if record["next_attempt_at"] > now:
+                continue
+            path = os.path.join(self.retry_directory, f"{record['id']}.json")
+            try:
+                self.store(record_value(record))
+            except Exception as e:
+                record["attempts"] += 1
+                record["error"] = f"{type(e).__name__}: {e}"
+                if is_transient(e) and record["attempts"] < self.config['max_attempts']:
+                    record["next_attempt_at"] = time.time() + self.backoff(record["attempts"])
+                    write_record(self.retry_directory, record)
+                    # The database is still unavailable, the other events can wait for the next pass
+                    return
+                self.dead_letter(record)
+            else:
+                with self.lock:
+                    self.counters["retried"] += 1
+            os.remove(path)
+            with self.lock:
+                self.counters["retry_pending"] -= 1
+
+    def run(self):
+        """ Retry thread: checks the spool every retry_base_sec """
+        while True:
+            try:
+                self.retry_due()
+            except Exception as e:
+                logger.error(f"Error retrying spooled events: {e}")
+            time.sleep(self.config['retry_base_sec'])
+
+    def start(self):
+        """ Starts the retry thread """
+        t = Thread(target=self.run)
+        t.setDaemon(True)
+        t.start()
+
+    def stats(self):
+        """ Counters of the lane """
+        with self.lock:
+            return dict(self.counters)
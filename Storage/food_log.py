@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime
+from sqlalchemy import Column, Integer, String, Float, DateTime, Index
+from sqlalchemy.dialects import mysql
 from base import Base
 import datetime
 
@@ -6,9 +7,13 @@ class FoodLog(Base):
     """ Food Log """
 
     __tablename__ = "food_log"
+    __table_args__ = (
+        Index("ix_food_log_date_created", "date_created"),
+        Index("ix_food_log_user_id_date_created", "user_id", "date_created"),
+    )
 
     id = Column(Integer, primary_key=True)
-    trace_id = Column(String, unique=True, nullable=False)
+    trace_id = Column(String(100), unique=True, nullable=False)
     user_id = Column(Integer, nullable=False)
     timestamp = Column(String(100), nullable=False)
     food_name = Column(String(250), nullable=False)
@@ -17,7 +22,7 @@ class FoodLog(Base):
     carbohydrates = Column(Integer, nullable=False)
     fats = Column(Integer, nullable=False)
     proteins = Column(Integer, nullable=False)
-    date_created = Column(DateTime, nullable=False)
+    date_created = Column(DateTime().with_variant(mysql.DATETIME(fsp=6), "mysql"), nullable=False)
 
     def __init__(self, trace_id, user_id, timestamp, food_name, quantity, calories, carbohydrates, fats, proteins):
         """ Initializes a food log entry """
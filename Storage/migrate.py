@@ -0,0 +1,156 @@
+"""
+Brings the Storage database schema up to date.
+
+    python3 migrate.py
+
+Every shard is migrated. Applied migrations are recorded in each database's
+schema_version table, so running this again only applies the new ones. Each migration is also written to be safe to
+re-run against tables that already have some of its changes.
+"""
+import mysql.connector
+import yaml
+import sharding
+
+
+def column_type(cursor, table, column):
+    """ Returns the full column type, e.g. 'varchar(100)' """
+    cursor.execute("SELECT COLUMN_TYPE FROM information_schema.COLUMNS "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s",
+                   (table, column))
+    row = cursor.fetchone()
+    return row[0].decode() if isinstance(row[0], bytes) else row[0]
+
+
+def index_exists(cursor, table, index):
+    """ Whether the table has an index (or unique key) with that name """
+    cursor.execute("SELECT COUNT(*) FROM information_schema.STATISTICS "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s",
+                   (table, index))
+    return cursor.fetchone()[0] > 0
+
+
+def create_tables(cursor):
+    """ The original tables, as created by the first version of create_tables_mysql.py """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS personal_info (
+    id INT NOT NULL AUTO_INCREMENT,
+    trace_id VARCHAR(100) NOT NULL,
+    user_id INT NOT NULL,
+    age INT NOT NULL,
+    sex VARCHAR(10) NOT NULL,
+    height INT NOT NULL,
+    weight INT NOT NULL,
+    activity_level VARCHAR(50) NOT NULL,
+    nutritional_goal VARCHAR(50) NOT NULL,
+    date_created VARCHAR(100) NOT NULL,
+    CONSTRAINT personal_info_pk PRIMARY KEY (id))
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS food_log (
+    id INT NOT NULL AUTO_INCREMENT,
+    trace_id VARCHAR(100) NOT NULL,
+    user_id INT NOT NULL,
+    timestamp VARCHAR(100) NOT NULL,
+    food_name VARCHAR(250) NOT NULL,
+    quantity INT NOT NULL,
+    calories INT NOT NULL,
+    carbohydrates INT NOT NULL,
+    fats INT NOT NULL,
+    proteins INT NOT NULL,
+    date_created VARCHAR(100) NOT NULL,
+    CONSTRAINT food_log_pk PRIMARY KEY (id))
+    ''')
+
+
+def index_tables(cursor):
+    """ DATETIME(6) date_created, a unique trace_id and indexes for the range queries, converted in place """
+    for table in ("personal_info", "food_log"):
+        # Keep the first copy of any duplicated event so the unique key can be added
+        cursor.execute(f"DELETE dup FROM {table} dup JOIN {table} orig "
+                       f"ON dup.trace_id = orig.trace_id AND dup.id > orig.id")
+
+        changes = []
+        if column_type(cursor, table, "date_created") != "datetime(6)":
+            # Values were written as 'YYYY-MM-DD HH:MM:SS[.ffffff]', which MySQL converts directly
+            changes.append("MODIFY date_created DATETIME(6) NOT NULL")
+        if not index_exists(cursor, table, f"{table}_trace_id_uk"):
+            changes.append(f"ADD CONSTRAINT {table}_trace_id_uk UNIQUE (trace_id)")
+        if not index_exists(cursor, table, f"ix_{table}_date_created"):
+            changes.append(f"ADD INDEX ix_{table}_date_created (date_created)")
+        if not index_exists(cursor, table, f"ix_{table}_user_id_date_created"):
+            changes.append(f"ADD INDEX ix_{table}_user_id_date_created (user_id, date_created)")
+
+        # One ALTER so the table is only rebuilt once
+        if changes:
+            cursor.execute(f"ALTER TABLE {table} " + ", ".join(changes))
+
+
+def create_daily_nutrition(cursor):
+    """ Per user and day food log totals, filled from the rows already stored """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_nutrition (
+    user_id INT NOT NULL,
+    day DATE NOT NULL,
+    entries INT NOT NULL,
+    quantity INT NOT NULL,
+    calories INT NOT NULL,
+    carbohydrates INT NOT NULL,
+    fats INT NOT NULL,
+    proteins INT NOT NULL,
+    date_updated DATETIME(6) NOT NULL,
+    CONSTRAINT daily_nutrition_pk PRIMARY KEY (user_id, day))
+    ''')
+    # Same totals as rebuild_daily_nutrition.py
+    cursor.execute("DELETE FROM daily_nutrition")
+    cursor.execute("INSERT INTO daily_nutrition "
+                   "(user_id, day, entries, quantity, calories, carbohydrates, fats, proteins, date_updated) "
+                   "SELECT user_id, LEFT(timestamp, 10), COUNT(*), SUM(quantity), SUM(calories), "
+                   "SUM(carbohydrates), SUM(fats), SUM(proteins), MAX(date_created) "
+                   "FROM food_log GROUP BY user_id, LEFT(timestamp, 10)")
+
+
+MIGRATIONS = [
+    (1, "create tables", create_tables),
+    (2, "indexed schema", index_tables),
+    (3, "daily nutrition rollup", create_daily_nutrition),
+]
+
+
+def migrate(db_conn):
+    """ Applies every migration newer than the recorded schema version """
+    db_cursor = db_conn.cursor()
+    db_cursor.execute("CREATE TABLE IF NOT EXISTS schema_version ("
+                      "version INT NOT NULL PRIMARY KEY, "
+                      "description VARCHAR(100) NOT NULL, "
+                      "applied_at DATETIME NOT NULL)")
+    db_cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    current_version = db_cursor.fetchone()[0]
+
+    for version, description, apply in MIGRATIONS:
+        if version <= current_version:
+            continue
+        print(f"Applying migration {version}: {description}")
+        apply(db_cursor)
+        db_cursor.execute("INSERT INTO schema_version (version, description, applied_at) "
+                          "VALUES (%s, %s, NOW())", (version, description))
+        db_conn.commit()
+
+    db_cursor.close()
+
+
+if __name__ == "__main__":
+    with open('app_conf.yml', 'r') as f:
+        app_config = yaml.safe_load(f.read())
+
+    for shard in sharding.shard_configs(app_config['datastore']):
+        print(f"Migrating shard {shard['number']} ({shard['hostname']}:{shard['port']}/{shard['db']})")
+        db_conn = mysql.connector.connect(
+            host=shard['hostname'],
+            user=shard['user'],
+            password=shard['password'],
+            database=shard['db'],
+            port=shard['port'],
+            auth_plugin='mysql_native_password')
+
+        migrate(db_conn)
+        db_conn.close()
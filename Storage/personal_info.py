@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime
+from sqlalchemy import Column, Integer, String, Float, DateTime, Index
+from sqlalchemy.dialects import mysql
 from base import Base
 import datetime
 
@@ -7,6 +8,10 @@ class PersonalInfo(Base):
     """ Personal Info """
 
     __tablename__ = "personal_info"
+    __table_args__ = (
+        Index("ix_personal_info_date_created", "date_created"),
+        Index("ix_personal_info_user_id_date_created", "user_id", "date_created"),
+    )
 
     id = Column(Integer, primary_key=True)
     trace_id = Column(String(100), unique=True, nullable=False)
@@ -17,7 +22,7 @@ class PersonalInfo(Base):
     sex = Column(String(10), nullable=False)
     user_id = Column(Integer, nullable=True)
     weight = Column(Integer, nullable=True)
-    date_created = Column(DateTime, nullable=False)
+    date_created = Column(DateTime().with_variant(mysql.DATETIME(fsp=6), "mysql"), nullable=False)
 
 
     def __init__(self, trace_id, activity_level, age, height, nutritional_goal, sex, user_id, weight):
@@ -0,0 +1,88 @@
+"""
+Engines the read endpoints use, kept apart from the consumer's writes.
+
+Each replica gets its own connection pool. A connection is taken from a
+healthy replica, picked round robin or by fewest connections in use; a replica
+that fails to connect is skipped for a while. Without a healthy replica reads
+go to the primary, through a pool of their own.
+"""
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from threading import Lock
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger('basicLogger')
+
+
+def engine_url(datastore, replica=None):
+    """ Database URL of the primary, or of a replica whose unset settings default to the primary's """
+    settings = replica if replica else datastore
+    if "url" in settings:
+        return settings["url"]
+    settings = dict(datastore, **(replica or {}))
+    return (f"mysql+pymysql://{settings['user']}:{settings['password']}@"
+            f"{settings['hostname']}:{settings['port']}/{settings['db']}")
+
+
+def read_engine(url, pool_config):
+    """ Engine with the read pool's settings (SQLite stand-ins do not take pool sizes) """
+    if url.startswith("sqlite"):
+        return create_engine(url, pool_pre_ping=pool_config['pool_pre_ping'])
+    return create_engine(url,
+                         pool_size=pool_config['pool_size'],
+                         max_overflow=pool_config['max_overflow'],
+                         pool_pre_ping=pool_config['pool_pre_ping'])
+
+
+class ReadPool:
+    """ Hands out read connections from the replicas, falling back to the primary """
+
+    def __init__(self, primary, replicas, selection="round_robin", unhealthy_sec=30):
+        self.primary = primary
+        self.replicas = replicas
+        self.selection = selection
+        self.unhealthy_sec = unhealthy_sec
+        self.in_use = {engine: 0 for engine in [primary] + replicas}
+        self.unhealthy_until = {engine: 0.0 for engine in replicas}
+        self.next_replica = itertools.cycle(range(len(replicas))) if replicas else None
+        self.lock = Lock()
+
+    def candidates(self):
+        """ Healthy replicas in the order to try them, then the primary """
+        now = time.time()
+        with self.lock:
+            healthy = [engine for engine in self.replicas if self.unhealthy_until[engine] <= now]
+            if self.selection == "least_busy":
+                healthy.sort(key=lambda engine: self.in_use[engine])
+            elif healthy:
+                start = next(self.next_replica) % len(healthy)
+                healthy = healthy[start:] + healthy[:start]
+        return healthy + [self.primary]
+
+    @contextmanager
+    def connect(self):
+        """ A connection from the first candidate that accepts one """
+        for engine in self.candidates():
+            try:
+                connection = engine.connect()
+            except DBAPIError as e:
+                if engine is self.primary:
+                    raise
+                logger.warning(f"Read replica {engine.url.host or engine.url} unavailable, "
+                               f"skipping it for {self.unhealthy_sec}s: {e}")
+                with self.lock:
+                    self.unhealthy_until[engine] = time.time() + self.unhealthy_sec
+                continue
+
+            with self.lock:
+                self.in_use[engine] += 1
+            try:
+                yield connection
+            finally:
+                connection.close()
+                with self.lock:
+                    self.in_use[engine] -= 1
+            return
@@ -0,0 +1,69 @@
+"""
+Range reads of the readings tables with SQLAlchemy Core.
+
+Rows are fetched as plain tuples in chunks from a server-side cursor and turned
+straight into JSON-ready dictionaries, without building an ORM object per row.
+"""
+from sqlalchemy import select, DateTime
+
+
+def reading_columns(model, fields):
+    """ Columns to read for a fields= projection (id is always included), all of them without one """
+    columns = model.__table__.columns
+    if not fields:
+        return list(columns)
+    unknown = [field for field in fields if field not in columns]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return [columns.id] + [columns[field] for field in fields if field != "id"]
+
+
+def select_readings(model, columns, start, end, limit, after_id, order_by=None, user_ids=None):
+    """
+    Core SELECT for the readings in a window, in id order when paginating (or order_by's, e.g. "date_created"),
+    only those of user_ids when given
+    """
+    table = model.__table__
+    statement = select(*columns).where(table.c.date_created >= start, table.c.date_created < end)
+    if user_ids is not None:
+        statement = statement.where(table.c.user_id.in_(user_ids))
+    if after_id is not None:
+        statement = statement.where(table.c.id > after_id)
+    if limit is not None or after_id is not None:
+        statement = statement.order_by(table.c.id)
+    elif order_by is not None:
+        statement = statement.order_by(table.c[order_by], table.c.id)
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+
+def select_trace(model, trace_id):
+    """ Core SELECT for the reading with a trace_id, at most one since the column is unique """
+    table = model.__table__
+    return select(*table.columns).where(table.c.trace_id == trace_id)
+
+
+def datetime_column_names(columns):
+    """ Names of the DateTime columns, which JSON needs as strings """
+    return [column.name for column in columns
+            if isinstance(getattr(column.type, "impl", column.type), DateTime)]
+
+
+def to_readings(names, datetime_names, rows):
+    """ Turns row tuples into JSON-ready reading dictionaries """
+    readings = [dict(zip(names, row)) for row in rows]
+    for reading in readings:
+        for name in datetime_names:
+            # Same format as connexion's FlaskJSONEncoder
+            reading[name] = reading[name].isoformat() + "Z"
+    return readings
+
+
+def fetch_readings(connection, columns, statement, chunk_rows):
+    """ Runs a readings SELECT on a server-side cursor, yielding chunks of reading dictionaries """
+    names = [column.name for column in columns]
+    datetime_names = datetime_column_names(columns)
+    result = connection.execution_options(stream_results=True).execute(statement)
+    for rows in result.partitions(chunk_rows):
+        yield to_readings(names, datetime_names, rows)
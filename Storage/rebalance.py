@@ -0,0 +1,123 @@
+"""
+Moves users to the shard the hash ring assigns them, e.g. after adding a shard.
+
+    python3 rebalance.py
+    python3 rebalance.py --dry-run
+
+Storage routes a user's new events to their new shard as soon as it restarts
+with the new datastore.shards; this moves the rows they already had. For every
+shard, the users on it that now hash elsewhere are moved a batch at a time:
+
+  1. their food log and personal info rows are copied to the new shard (rows
+     already there are skipped), its daily_nutrition totals for them are
+     recomputed, and totals of archived days are copied over as they are
+  2. their rows and totals are deleted from the old shard
+
+Each step can be repeated, so an interrupted run is finished by running it
+again. Until step 2 commits, range reads return a moved batch from both shards.
+Archived rows stay in the old shard's archive, which range reads still open.
+"""
+import argparse
+import yaml
+from sqlalchemy import select, union
+from sqlalchemy.dialects import mysql, sqlite
+import archive
+import sharding
+import writer
+from backfill import invalidate_cache
+from daily_nutrition import DailyNutrition
+from food_log import FoodLog
+from personal_info import PersonalInfo
+
+TABLES = (FoodLog.__table__, PersonalInfo.__table__)
+
+
+def users_to_move(router, shard):
+    """ Users with rows on the shard who belong on another one """
+    with shard.engine.connect() as connection:
+        user_ids = connection.execute(union(*[select(table.c.user_id) for table in TABLES],
+                                            select(DailyNutrition.__table__.c.user_id))).scalars().all()
+    return sorted(user_id for user_id in user_ids if router.for_user(user_id) is not shard)
+
+
+def replace_totals(connection, totals):
+    """ Writes daily_nutrition rows as they are, overwriting the same user and day """
+    if not totals:
+        return
+    table = DailyNutrition.__table__
+    values = {column.name: column.name for column in table.columns if not column.primary_key}
+    if connection.dialect.name == 'mysql':
+        statement = mysql.insert(table)
+        statement = statement.on_duplicate_key_update(**{name: statement.inserted[name] for name in values})
+    else:
+        statement = sqlite.insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=['user_id', 'day'], set_={name: statement.excluded[name] for name in values})
+    connection.execute(statement, totals)
+
+
+def move_users(router, source, user_ids, from_day):
+    """
+    Copies the users' rows to their shards, then deletes them from the source shard.
+    from_day is the end of the source shard's archive: earlier totals are copied as they are.
+    """
+    rollup = DailyNutrition.__table__
+    with source.engine.connect() as connection:
+        rows = []
+        for table in TABLES:
+            columns = [column for column in table.columns if column.name != "id"]
+            rows += [(table, dict(row._mapping)) for row in
+                     connection.execute(select(*columns).where(table.c.user_id.in_(user_ids)))]
+        archived_totals = []
+        if from_day is not None:
+            archived_totals = [dict(row._mapping) for row in connection.execute(
+                select(rollup).where(rollup.c.user_id.in_(user_ids), rollup.c.day < from_day))]
+
+    for target in {router.for_user(user_id) for user_id in user_ids}:
+        target_users = [user_id for user_id in user_ids if router.for_user(user_id) is target]
+        with target.engine.begin() as connection:
+            writer.write_rows(connection, [(table, row) for table, row in rows if row["user_id"] in target_users])
+            writer.rebuild_rollup(connection, from_day, target_users)
+            replace_totals(connection, [totals for totals in archived_totals if totals["user_id"] in target_users])
+
+    with source.engine.begin() as connection:
+        for table in TABLES + (rollup,):
+            connection.execute(table.delete().where(table.c.user_id.in_(user_ids)))
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move users to the shard the hash ring assigns them")
+    parser.add_argument("--batch-users", type=int, default=100, help="users moved per transaction")
+    parser.add_argument("--dry-run", action="store_true", help="only count the users to move")
+    parser.add_argument("--config", default="app_conf.yml", help="Storage app_conf.yml to read")
+    parser.add_argument("--storage-url", help="Storage base URL whose window cache to invalidate when done")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        app_config = yaml.safe_load(f.read())
+
+    router, _ = sharding.write_router(app_config)
+
+    for shard in router.shards:
+        # From what archive.py actually wrote on the source shard, whatever older_than_days says now
+        from_day = None
+        if app_config['archive']['enabled']:
+            archived_until = archive.archived_until(shard.archive_path)
+            from_day = None if archived_until is None else archived_until.date()
+        user_ids = users_to_move(router, shard)
+        print(f"Shard {shard.number}: {len(user_ids)} users to move")
+        if args.dry_run:
+            continue
+        for first in range(0, len(user_ids), args.batch_users):
+            batch = user_ids[first:first + args.batch_users]
+            rows = move_users(router, shard, batch, from_day)
+            print(f"Shard {shard.number}: moved {first + len(batch)}/{len(user_ids)} users ({rows} rows)")
+
+    if args.storage_url and not args.dry_run:
+        # Moved rows get new ids
+        invalidate_cache(args.storage_url, None)
+
+
+if __name__ == "__main__":
+    main()
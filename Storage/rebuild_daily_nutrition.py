@@ -0,0 +1,45 @@
+"""
+Recomputes the daily_nutrition rollup from the food_log table.
+
+    python3 rebuild_daily_nutrition.py
+
+The Storage consumer keeps the rollup up to date as it inserts food log rows;
+this is for after a restore, a manual fix to food_log or a change to how the
+rollup is computed. It runs in one transaction, so readers see either the old
+or the new totals, and live inserts wait for it to finish.
+
+When the archive is enabled, a shard's days up to the newest one in its
+archive are no longer fully in food_log and keep their current totals.
+"""
+import argparse
+import time
+import yaml
+import archive
+import sharding
+import writer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild daily_nutrition from food_log")
+    parser.add_argument("--config", default="app_conf.yml", help="Storage app_conf.yml to read")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        app_config = yaml.safe_load(f.read())
+
+    router, _ = sharding.write_router(app_config)
+
+    for shard in router.shards:
+        # From what archive.py actually wrote, whatever older_than_days says now
+        from_day = None
+        if app_config['archive']['enabled']:
+            archived_until = archive.archived_until(shard.archive_path)
+            from_day = None if archived_until is None else archived_until.date()
+        started = time.time()
+        with shard.engine.begin() as connection:
+            rows = writer.rebuild_rollup(connection, from_day)
+        print(f"Rebuilt {rows} daily_nutrition rows on shard {shard.number} in {time.time() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
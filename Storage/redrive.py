@@ -0,0 +1,117 @@
+"""
+Replays dead-lettered events into the Storage database.
+
+    python3 redrive.py              # from the configured dlq.sink
+    python3 redrive.py --dry-run    # only list them
+
+With sink: spool, each record under <dlq.path>/dead/ is stored and removed; one
+that fails again stays with its new error. With sink: topic, the dead letter
+topic is read in its own consumer group, up to its current end, and an event
+that fails again is produced back onto it. Fix whatever made the events fail
+first (a schema change, a bad deploy), then run this.
+"""
+import argparse
+import json
+import os
+import yaml
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
+import dead_letter
+import envelope
+import sharding
+import writer
+
+
+def retry(router, record):
+    """ Stores a record's event, returning the error it failed with, if any """
+    try:
+        rows = [writer.message_to_row(envelope.decode(dead_letter.record_value(record)))]
+        writer.write_sharded_rows(router, rows)
+        return None
+    except Exception as e:
+        record["attempts"] += 1
+        record["error"] = f"{type(e).__name__}: {e}"
+        return e
+
+
+def redrive_spool(router, config, dry_run):
+    """ Replays the records of the dead letter spool directory """
+    directory = os.path.join(config['path'], "dead")
+    records = dead_letter.read_records(directory) if os.path.isdir(directory) else []
+    stored = 0
+    for record in records:
+        if dry_run:
+            print(f"{record['id']} partition {record['partition']} offset {record['offset']}: {record['error']}")
+            continue
+        if retry(router, record) is None:
+            os.remove(os.path.join(directory, f"{record['id']}.json"))
+            stored += 1
+        else:
+            dead_letter.write_record(directory, record)
+    return stored, len(records)
+
+
+def redrive_topic(router, app_config, dry_run):
+    """ Replays the records of the dead letter topic that were not redriven yet """
+    client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
+    topic = client.topics[str.encode(app_config['dlq']['topic'])]
+    # Stop at the records present now, so ones produced back below are left for the next run
+    end_offsets = {partition.id: partition.latest_available_offset() - 1 for partition in topic.partitions.values()}
+    consumer = topic.get_simple_consumer(consumer_group=b'dlq_redrive',
+                                         auto_offset_reset=OffsetType.EARLIEST,
+                                         reset_offset_on_start=False,
+                                         consumer_timeout_ms=5000)
+    pending = {partition_id for partition_id, end_offset in end_offsets.items()
+               if consumer.held_offsets.get(partition_id, -1) < end_offset}
+
+    stored = total = 0
+    # Partition id -> last offset redriven, committed at the end
+    redriven = {}
+    with topic.get_sync_producer() as producer:
+        while pending:
+            msg = consumer.consume()
+            if msg is None:
+                break
+            if msg.offset > end_offsets[msg.partition_id]:
+                # Produced back by this run while another partition is still pending
+                continue
+            if msg.offset == end_offsets[msg.partition_id]:
+                pending.discard(msg.partition_id)
+            redriven[msg.partition_id] = msg.offset
+
+            record = json.loads(msg.value)
+            total += 1
+            if dry_run:
+                print(f"{record['id']} partition {record['partition']} offset {record['offset']}: {record['error']}")
+                continue
+            if retry(router, record) is None:
+                stored += 1
+            else:
+                producer.produce(json.dumps(record).encode('utf-8'))
+    if not dry_run and redriven:
+        # Not the consumer's own position, which may be past records skipped above
+        consumer.commit_offsets([(topic.partitions[partition_id], offset + 1)
+                                 for partition_id, offset in redriven.items()])
+    consumer.stop()
+    return stored, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay dead-lettered events into the Storage database")
+    parser.add_argument("--dry-run", action="store_true", help="list the dead-lettered events without storing them")
+    parser.add_argument("--config", default="app_conf.yml", help="Storage app_conf.yml to read")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        app_config = yaml.safe_load(f.read())
+
+    router, _ = sharding.write_router(app_config)
+    if app_config['dlq']['sink'] == 'topic':
+        stored, total = redrive_topic(router, app_config, args.dry_run)
+    else:
+        stored, total = redrive_spool(router, app_config['dlq'], args.dry_run)
+    print(f"Redrove {stored} of {total} dead-lettered events")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Spreads users over several Storage databases.
+
+Each entry of datastore.shards is a database; settings it leaves out default to
+the datastore ones. A user's rows all live on one shard, picked by consistent
+hashing of user_id on a ring of virtual nodes, so adding a shard only moves
+about 1/N of the users (rebalance.py copies their rows over). Without shards
+the datastore itself is the only shard and nothing changes.
+
+Row ids are per database, so when sharded the ids returned by the read
+endpoints are local_id * ID_SPACE + shard number, which keeps them unique and
+usable as after_id. Shard numbers must therefore never be reused or changed.
+"""
+import bisect
+import hashlib
+import os
+from sqlalchemy import create_engine
+from read_pool import engine_url
+
+ID_SPACE = 1024
+VIRTUAL_NODES = 100
+
+
+def ring_hash(value):
+    """ Position on the ring (hash() is randomized per process, so md5 it is) """
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+def shard_configs(datastore):
+    """ Settings of every shard, each with its number; the datastore itself when there are none """
+    if not datastore.get('shards'):
+        return [dict(datastore, number=0)]
+
+    configs = []
+    for shard in datastore['shards']:
+        if not 0 <= shard['number'] < ID_SPACE:
+            raise ValueError(f"Shard number {shard['number']} must be between 0 and {ID_SPACE - 1}")
+        config = {key: value for key, value in datastore.items() if key not in ('shards', 'replicas')}
+        config.update(shard)
+        configs.append(config)
+    if len({config['number'] for config in configs}) != len(configs):
+        raise ValueError("Shard numbers must be unique")
+    return configs
+
+
+class HashRing:
+    """ Consistent hash ring of shard numbers """
+
+    def __init__(self, numbers, virtual_nodes=VIRTUAL_NODES):
+        points = sorted((ring_hash(f"shard-{number}#{i}"), number)
+                        for number in numbers for i in range(virtual_nodes))
+        self.hashes = [point[0] for point in points]
+        self.numbers = [point[1] for point in points]
+
+    def shard_for(self, user_id):
+        """ Number of the shard that owns a user """
+        i = bisect.bisect(self.hashes, ring_hash(str(user_id))) % len(self.hashes)
+        return self.numbers[i]
+
+
+class Shard:
+    """ One database: its write engine, its read pool and where its archive lives """
+
+    def __init__(self, number, engine, read_pool, archive_path):
+        self.number = number
+        self.engine = engine
+        self.read_pool = read_pool
+        self.archive_path = archive_path
+
+
+class ShardRouter:
+    """ Picks the shard of a user and translates row ids when there is more than one """
+
+    def __init__(self, shards, sharded):
+        self.shards = shards
+        self.sharded = sharded
+        self.by_number = {shard.number: shard for shard in shards}
+        self.ring = HashRing(self.by_number)
+
+    def for_user(self, user_id):
+        """ The shard that owns a user """
+        return self.by_number[self.ring.shard_for(user_id)]
+
+    def split_rows(self, rows):
+        """ Groups (table, row) pairs by the shard of their user """
+        rows_by_shard = {}
+        for table, row in rows:
+            rows_by_shard.setdefault(self.for_user(row["user_id"]), []).append((table, row))
+        return rows_by_shard
+
+    def global_id(self, shard, local_id):
+        """ Id a row is returned with """
+        return local_id * ID_SPACE + shard.number if self.sharded else local_id
+
+    def local_after_id(self, shard, after_id):
+        """ The shard's own id that an after_id of the merged results corresponds to """
+        if after_id is None or not self.sharded:
+            return after_id
+        return (after_id - shard.number) // ID_SPACE
+
+
+def archive_path(root, number, sharded):
+    """ Archive directory of a shard """
+    return os.path.join(root, f"shard-{number}") if sharded else root
+
+
+def write_router(app_config):
+    """ Router over every configured shard, each with a write engine (read_pool is left to the caller) """
+    configs = shard_configs(app_config['datastore'])
+    sharded = bool(app_config['datastore'].get('shards'))
+    shards = [Shard(config['number'], create_engine(engine_url(config)), None,
+                    archive_path(app_config['archive']['path'], config['number'], sharded))
+              for config in configs]
+    return ShardRouter(shards, sharded), configs
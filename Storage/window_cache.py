@@ -0,0 +1,91 @@
+"""
+Cache of serialized range reads for windows that have already closed.
+
+Readings are stored with date_created set to the time they are written, so a
+window ending safely in the past only changes when older events are written
+(e.g. by backfill.py). Those writes call invalidate() with the range they
+touched; every entry overlapping it is dropped.
+"""
+from collections import OrderedDict, deque
+from threading import Lock
+
+
+class WindowCache:
+    """ LRU cache of response bodies keyed by table and query window, bounded by their total size """
+
+    def __init__(self, max_bytes, invalidations_kept=1000):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        # Bumped by every invalidation; recent ones are kept so a read that raced with an
+        # overlapping write is not cached
+        self.generation = 0
+        self.recent_invalidations = deque(maxlen=invalidations_kept)
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+        self.lock = Lock()
+
+    def get(self, key):
+        """ Returns the cached (body, headers) for a key, or None """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[0], entry[1]
+
+    def put(self, key, body, headers, start, end, generation):
+        """ Caches a body read for the window [start, end) when nothing was invalidated since the read started """
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if self.invalidated_since(generation, key[0], start, end):
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[key] = (body, headers, start, end)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (evicted, _, _, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.counters["evictions"] += 1
+
+    def invalidated_since(self, generation, table, start, end):
+        """ Whether an invalidation after that generation overlaps the window (called with the lock held) """
+        if generation == self.generation:
+            return False
+        if not self.recent_invalidations or self.recent_invalidations[0][0] > generation + 1:
+            # Older invalidations are no longer known
+            return True
+        return any(overlaps(invalidation, table, start, end)
+                   for invalidation in self.recent_invalidations if invalidation[0] > generation)
+
+    def invalidate(self, table, start=None, end=None):
+        """ Drops cached windows of a table (all tables if None) overlapping [start, end], unbounded if None """
+        with self.lock:
+            self.generation += 1
+            invalidation = (self.generation, table, start, end)
+            self.recent_invalidations.append(invalidation)
+            for key, (body, _, entry_start, entry_end) in list(self.entries.items()):
+                if not overlaps(invalidation, key[0], entry_start, entry_end):
+                    continue
+                del self.entries[key]
+                self.size -= len(body)
+                self.counters["invalidations"] += 1
+
+    def stats(self):
+        """ Counters and current size """
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), bytes=self.size, max_bytes=self.max_bytes)
+
+
+def overlaps(invalidation, table, start, end):
+    """ Whether a (generation, table, start, end) invalidation covers part of a table's window [start, end) """
+    _, invalidated_table, invalidated_start, invalidated_end = invalidation
+    if invalidated_table is not None and invalidated_table != table:
+        return False
+    if invalidated_start is not None and end <= invalidated_start:
+        return False
+    return invalidated_end is None or start <= invalidated_end
@@ -0,0 +1,173 @@
+from sqlalchemy import select, func
+from sqlalchemy.dialects import mysql, sqlite
+from food_log import FoodLog
+from personal_info import PersonalInfo
+from daily_nutrition import DailyNutrition
+import datetime
+
+ROLLUP_FIELDS = ("quantity", "calories", "carbohydrates", "fats", "proteins")
+
+
+def message_to_row(msg, date_created=None):
+    """ Converts a decoded event message to a (table, row) pair for a bulk insert """
+    payload = msg["payload"]
+    if date_created is None:
+        date_created = datetime.datetime.now()
+
+    if msg["type"] == "food_log":
+        return FoodLog.__table__, {
+            "trace_id": payload["trace_id"],
+            "user_id": payload["user_id"],
+            "timestamp": payload["timestamp"],
+            "food_name": payload["food_name"],
+            "quantity": payload["quantity"],
+            "calories": payload["calories"],
+            "carbohydrates": payload["carbohydrates"],
+            "fats": payload["fats"],
+            "proteins": payload["proteins"],
+            "date_created": date_created
+        }
+
+    if msg["type"] == "personal_info":
+        return PersonalInfo.__table__, {
+            "trace_id": payload["trace_id"],
+            "activity_level": payload["activity_level"],
+            "age": payload["age"],
+            "height": payload["height"],
+            "nutritional_goal": payload["nutritional_goal"],
+            "sex": payload["sex"],
+            "user_id": payload["user_id"],
+            "weight": payload["weight"],
+            "date_created": date_created
+        }
+
+    raise ValueError(f"Unknown event type {msg['type']}")
+
+
+def insert_ignoring_duplicates(table, dialect_name):
+    """ INSERT statement that skips rows whose trace_id is already stored """
+    if dialect_name == 'mysql':
+        statement = mysql.insert(table)
+        return statement.on_duplicate_key_update(trace_id=statement.inserted.trace_id)
+    if dialect_name == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing(index_elements=['trace_id'])
+    return table.insert()
+
+
+def meal_day(timestamp):
+    """ The day a food log entry counts towards, from its YYYY-MM-DDTHH:MM:SSZ timestamp """
+    return datetime.datetime.strptime(timestamp[:10], "%Y-%m-%d").date()
+
+
+def stored_trace_ids(connection, table, trace_ids):
+    """ The trace IDs among trace_ids that the transaction can see stored in table """
+    return set(connection.execute(select(table.c.trace_id).where(table.c.trace_id.in_(trace_ids))).scalars())
+
+
+def insert_food_logs(connection, table, rows):
+    """
+    Inserts food log rows ignoring duplicate trace IDs, returning the rows this transaction inserted.
+
+    Nothing is locked before the insert: the first read takes the transaction's
+    snapshot (InnoDB's default REPEATABLE READ), so reading the trace IDs again
+    afterwards only adds the rows inserted here, not ones a concurrent writer of
+    the same events committed in the meantime.
+    """
+    stored = stored_trace_ids(connection, table, [row["trace_id"] for row in rows])
+    fresh = []
+    for row in rows:
+        if row["trace_id"] not in stored:
+            stored.add(row["trace_id"])
+            fresh.append(row)
+    if not fresh:
+        return []
+
+    connection.execute(insert_ignoring_duplicates(table, connection.dialect.name), fresh)
+    inserted = stored_trace_ids(connection, table, [row["trace_id"] for row in fresh])
+    return [row for row in fresh if row["trace_id"] in inserted]
+
+
+def add_to_rollup(connection, food_log_rows):
+    """ Adds food log rows to their user's daily_nutrition totals """
+    totals = {}
+    for row in food_log_rows:
+        key = (row["user_id"], meal_day(row["timestamp"]))
+        total = totals.setdefault(key, dict({field: 0 for field in ROLLUP_FIELDS}, entries=0))
+        total["entries"] += 1
+        for field in ROLLUP_FIELDS:
+            total[field] += row[field]
+
+    now = datetime.datetime.now()
+    # Sorted so concurrent writers take the row locks in the same order
+    values = [dict(total, user_id=user_id, day=day, date_updated=now)
+              for (user_id, day), total in sorted(totals.items())]
+    if not values:
+        return
+
+    table = DailyNutrition.__table__
+    added = ("entries",) + ROLLUP_FIELDS
+    if connection.dialect.name == 'mysql':
+        statement = mysql.insert(table)
+        statement = statement.on_duplicate_key_update(
+            date_updated=statement.inserted.date_updated,
+            **{field: table.c[field] + statement.inserted[field] for field in added})
+    else:
+        statement = sqlite.insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=['user_id', 'day'],
+            set_=dict({field: table.c[field] + statement.excluded[field] for field in added},
+                      date_updated=statement.excluded.date_updated))
+    connection.execute(statement, values)
+
+
+def write_rows(connection, rows):
+    """
+    Inserts (table, row) pairs with one executemany per table, skipping duplicate trace IDs.
+    New food log rows are added to daily_nutrition in the same transaction.
+    """
+    rows_by_table = {}
+    for table, row in rows:
+        rows_by_table.setdefault(table, []).append(row)
+
+    for table, table_rows in rows_by_table.items():
+        if table is FoodLog.__table__:
+            add_to_rollup(connection, insert_food_logs(connection, table, table_rows))
+        else:
+            connection.execute(insert_ignoring_duplicates(table, connection.dialect.name), table_rows)
+
+
+def write_sharded_rows(router, rows):
+    """ Writes (table, row) pairs in one transaction per shard their users belong to """
+    for shard, shard_rows in router.split_rows(rows).items():
+        with shard.engine.begin() as connection:
+            write_rows(connection, shard_rows)
+
+
+def rebuild_rollup(connection, from_day=None, user_ids=None):
+    """
+    Recomputes the daily_nutrition totals from food_log with one INSERT ... SELECT.
+    With from_day, earlier days (e.g. ones whose rows were archived) are left as they are;
+    with user_ids, only those users' totals are recomputed.
+    The archive splits rows by date_created while days here are those of the meal timestamp,
+    so an archived row whose meal is dated from_day or later is still left out of its day's total.
+    """
+    table = DailyNutrition.__table__
+    food_log = FoodLog.__table__
+    day = func.substr(food_log.c.timestamp, 1, 10)
+    totals = select(food_log.c.user_id, day, func.count(),
+                    *[func.sum(food_log.c[field]) for field in ROLLUP_FIELDS],
+                    func.max(food_log.c.date_created)
+                    ).group_by(food_log.c.user_id, day)
+
+    delete = table.delete()
+    if from_day is not None:
+        totals = totals.where(day >= from_day.isoformat())
+        delete = delete.where(table.c.day >= from_day)
+    if user_ids is not None:
+        totals = totals.where(food_log.c.user_id.in_(user_ids))
+        delete = delete.where(table.c.user_id.in_(user_ids))
+
+    connection.execute(delete)
+    connection.execute(table.insert().from_select(
+        ["user_id", "day", "entries"] + list(ROLLUP_FIELDS) + ["date_updated"], totals))
+    return connection.execute(select(func.count()).select_from(table)).scalar()